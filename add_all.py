@@ -1,84 +1,904 @@
+import time
+_import_started = time.perf_counter()
 import dearpygui.dearpygui as dpg
-import psycopg2
-from psycopg2 import OperationalError, Error
+# Замеры этапов запуска для --profile-startup: (этап, секунды)
+STARTUP_PROFILE = [("import dearpygui", time.perf_counter() - _import_started)]
+import argparse
 import logging
-from datetime import datetime
 import os
-from transliterate import translit
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import json
+import select
+import queue
+import threading
+from collections import deque
+from nstlog import LOG_CONFIG, UI_LOGGER, setup_logging
 
 # ==================== КОНФИГУРАЦИЯ ====================
-DB_CONFIG = {
-    'host': 'localhost',
-    'port': '5432',
-    'dbname': 'gisp',
-    'user': 'gisp',
-    'password': 'gisp123'
+# Кнопка "Обновить":
+#   watermark 'xmin' - новые и измененные строки всех транзакций, не завершенных к прошлой синхронизации
+#                      (полный просмотр таблиц)
+#   watermark 'id'   - только строки с Id больше прошлого максимума (по индексу, быстрее), но строки
+#                      транзакции, которая получила Id раньше и закоммитилась позже чтения водяного знака
+#                      (например, массовое копирование другого оператора во время подключения), не будут
+#                      получены никогда; подходит, только если БД правит один оператор
+REFRESH_CONFIG = {
+    'watermark': 'xmin'
 }
 
-SQL_QUERIES = {
-    'get_maps': 'SELECT t."Id" as id, t."Name" as name FROM public."Maps" as t ORDER BY t."Name";',
-    'get_layers': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE t."Type" = \'xyz\' ORDER BY t."Name";',
-    'insert_layer': """
-        INSERT INTO public."Layers" (
-            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
-            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
-            "IsService"
-        ) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
-        RETURNING "Id"
-    """,
-    'check_layer_exists': """
-        SELECT 1 
-        FROM public."Layers" as t
-        WHERE t."MapId" = %s AND t."Name" = %s AND t."Type" = %s
-        LIMIT 1
-    """
+# Живое обновление кэша через LISTEN/NOTIFY (триггеры ставятся из меню "База данных")
+NOTIFY_CONFIG = {
+    'enabled': True,
+    'channel': 'nsttools_changes',
+    'poll_timeout': 1.0
+}
+
+# Работа в потоке GUI за один кадр: результаты фоновых задач и изменения из NOTIFY применяются
+# не дольше budget секунд, остаток переносится на следующие кадры
+FRAME_CONFIG = {
+    'budget': 0.01
+}
+
+# Фоновые задачи БД: количество рабочих потоков
+JOB_CONFIG = {
+    'max_workers': 2
+}
+
+# Окно "Метрики запросов": период автообновления таблицы (с) и каталог для экспорта снимков JSON
+METRICS_WINDOW_CONFIG = {
+    'refresh_interval': 1.0,
+    'export_dir': '.'
 }
 
-LOG_CONFIG = {
-    'level': logging.INFO,
-    'format': '%(asctime)s - %(levelname)s - %(message)s',
-    'handlers': [
-        logging.FileHandler('db_operations.log'),
-        logging.StreamHandler()
-    ]
+# Список слоев панели: таблица из visible_rows строк, которые переиспользуются при прокрутке,
+# поэтому отрисовываются только видимые слои независимо от размера карты.
+# wheel_rows - на сколько строк сдвигает список одно деление колеса мыши
+LAYER_LIST_CONFIG = {
+    'visible_rows': 15,
+    'row_height': 23,
+    'wheel_rows': 3
+}
+
+# Окно "Копирование в несколько карт": сколько найденных фильтром карт показывать списком
+# (отметить все найденные можно кнопкой независимо от этого ограничения)
+FANOUT_CONFIG = {
+    'max_shown': 500
+}
+
+# Подписи статусов в отчете копирования отмеченных слоев (copy_layers)
+COPY_REPORT_STATUS = {
+    'copied': "Скопирован",
+    'exists': "Уже есть в целевой карте",
+    'repeated': "Повтор имени и типа в наборе"
 }
 
 # ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
-db_connection = None
+db_pool = None
 all_maps = []
-all_layers = []
+layer_store = None
 left_panel_selected_map = None
 right_panel_selected_map = None
-selected_layers = {"left": None, "right": None}
-current_layers = {"left": [], "right": []}
+panels = {}  # "left"/"right" -> PanelView, создаются в create_main_window
+maps_index = None  # NameIndex по именам карт для фильтра над списком карт
+ui_queue = queue.Queue()
+db_changes = deque()  # изменения из NOTIFY: добавляет поток слушателя, разбирает apply_db_changes
+job_executor = None
+active_job = None
+change_listener = None
+sync_watermark = None
+unique_layer_index = False
+trgm_available = False  # установлен ли pg_trgm (нечеткий поиск в режиме 'paged')
+db_core_loaded = False
+metrics_refreshed = 0.0
+fanout_targets = set()  # Id целевых карт, отмеченных в окне "Копирование в несколько карт"
+ui_logger = logging.getLogger(UI_LOGGER)
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
-def log_query(query, params=None):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_message = f"[{timestamp}] Выполнен запрос: {query}"
-    if params:
-        log_message += f"\nПараметры: {params}"
-    logger.info(log_message)
-    print(log_message)
+def import_db_core():
+    # psycopg2 и ядро nsttools импортируются после первого кадра окна подключения, а не при запуске
+    global db_core_loaded, psycopg2, OperationalError, InterfaceError, Error
+    global DB_CONFIG, SQL_QUERIES, COPY_CONFIG, LOAD_CONFIG, DbPool, create_layer_store, log_query, stream_layers
+    global has_unique_layer_index, ensure_unique_layer_index, copy_layer, bulk_copy_layers, batch_copy_layers
+    global copy_layers, fanout_copy_layers, parallel_fanout_copy, PARALLEL_CONFIG, load_change_rows
+    global query_metrics, NameIndex, has_pg_trgm, create_browse_indexes, fetch_layer_page, count_browse_layers
+    if db_core_loaded:
+        return
+    started = time.perf_counter()
+    import psycopg2
+    import psycopg2.extensions
+    from psycopg2 import OperationalError, InterfaceError, Error
+    from nsttools import (
+        DB_CONFIG, SQL_QUERIES, COPY_CONFIG, LOAD_CONFIG, DbPool, create_layer_store, log_query, stream_layers,
+        has_unique_layer_index, ensure_unique_layer_index, copy_layer, bulk_copy_layers, batch_copy_layers,
+        copy_layers, fanout_copy_layers, parallel_fanout_copy, PARALLEL_CONFIG, load_change_rows,
+        query_metrics, NameIndex, has_pg_trgm, create_browse_indexes, fetch_layer_page, count_browse_layers
+    )
+    db_core_loaded = True
+    STARTUP_PROFILE.append(("import psycopg2 + nsttools", time.perf_counter() - started))
+
+    for tag, key in (("host_input", 'host'), ("port_input", 'port'), ("dbname_input", 'dbname'),
+                     ("username_input", 'user'), ("password_input", 'password')):
+        if not dpg.get_value(tag):
+            dpg.set_value(tag, DB_CONFIG[key])
+    if dpg.does_item_exist("fanout_workers"):
+        dpg.set_value("fanout_workers", PARALLEL_CONFIG['workers'])
 
 def toggle_fullscreen():
     dpg.maximize_viewport()
 
 def show_window(sender, app_data, user_data):
+    # Основное окно появляется только после подключения
+    if not dpg.does_item_exist(user_data):
+        return
     windows = ["connection_window", "main_window"]
     for window in windows:
+        if not dpg.does_item_exist(window):
+            continue
         if window == user_data:
             dpg.show_item(window)
         else:
             dpg.hide_item(window)
 
-def update_count_label(panel_side, count):
-    dpg.configure_item(f"{panel_side}_count_label", default_value=f"Количество: {count}")
+def set_map_combos():
+    # Список карт изменился: индекс для фильтра строится заново (карт немного)
+    global maps_index
+    maps_index = NameIndex((m[0], m[1]) for m in all_maps)
+    for panel_side in ("left", "right"):
+        filter_map_combo(panel_side)
+    fanout_targets.intersection_update(m[0] for m in all_maps)
+    if dpg.does_item_exist("fanout_maps_list"):
+        filter_fanout_maps()
+
+def filter_map_combo(panel_side):
+    text = dpg.get_value(f"{panel_side}_maps_filter") if dpg.does_item_exist(f"{panel_side}_maps_filter") else ""
+    found = maps_index.search(text) if maps_index is not None and text else None
+    map_names = [m[1] for m in all_maps if found is None or m[0] in found]
+    dpg.configure_item(f"{panel_side}_maps_combo", items=map_names)
+
+def on_maps_filter(sender, app_data, user_data):
+    filter_map_combo(user_data)
+
+def update_count_label(panel_side, count, total=None):
+    text = f"Количество: {count}" if total is None or total == count else f"Количество: {count} из {total}"
+    dpg.configure_item(f"{panel_side}_count_label", default_value=text)
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """Фоновая задача БД. Рабочий поток сообщает прогресс через progress(), GUI может отменить задачу."""
+
+    def __init__(self, label):
+        self.label = label
+        self.conn = None
+        self.started = time.monotonic()
+        self.rows_done = 0
+        self.rows_total = 0
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+        # Прерываем выполняющийся на сервере запрос (pg_cancel_backend для этого соединения)
+        if self.conn is not None and not self.conn.closed:
+            self.conn.cancel()
+
+    def progress(self, rows_done, rows_total):
+        if self.cancelled:
+            raise JobCancelled()
+        self.rows_done, self.rows_total = rows_done, rows_total
+        ui_queue.put((update_job_progress, (self,)))
+
+def submit_job(label, func, on_done, on_error, track=True):
+    """Запускает func(job) в пуле потоков; on_done/on_error вызываются в потоке GUI из drain_ui_queue.
+
+    Задачи с track=False (короткие чтения) не блокируют другие операции и не показывают окно прогресса.
+    """
+    global active_job
+    job = Job(label)
+    if track:
+        active_job = job
+        update_job_progress(job)
+        dpg.show_item("job_window")
+
+    def run():
+        try:
+            result = func(job)
+        except Exception as e:
+            if job.cancelled:
+                e = JobCancelled()
+            ui_queue.put((finish_job, (job, on_error, e)))
+        else:
+            ui_queue.put((finish_job, (job, on_done, result)))
+
+    job_executor.submit(run)
+    return job
+
+def finish_job(job, callback, value):
+    global active_job
+    if active_job is job:
+        active_job = None
+        dpg.hide_item("job_window")
+    logger.info(f"Задача '{job.label}' завершена за {time.monotonic() - job.started:.2f} с")
+    callback(value)
+
+def update_job_progress(job):
+    if active_job is not job:
+        return
+    elapsed = max(time.monotonic() - job.started, 1e-6)
+    if job.rows_total:
+        fraction = job.rows_done / job.rows_total
+        overlay = f"{job.label}: {job.rows_done}/{job.rows_total} строк, {job.rows_done / elapsed:.0f} строк/с"
+    else:
+        fraction = 0.0
+        overlay = f"{job.label}: выполняется..."
+    dpg.configure_item("job_progress_bar", default_value=fraction, overlay=overlay)
+
+def cancel_active_job():
+    if active_job:
+        logger.warning(f"Отмена задачи '{active_job.label}'")
+        active_job.cancel()
+
+def drain_ui_queue():
+    # Вызывается каждый кадр: применяет в потоке GUI результаты фоновых задач в пределах бюджета кадра
+    deadline = time.perf_counter() + FRAME_CONFIG['budget']
+    while time.perf_counter() < deadline:
+        try:
+            callback, args = ui_queue.get_nowait()
+        except queue.Empty:
+            return
+        # Ошибка одного обработчика не должна завершать цикл отрисовки
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception(f"Ошибка в обработчике {getattr(callback, '__qualname__', callback)}")
+
+def job_busy(status_tag):
+    if active_job:
+        error_msg = f"Дождитесь завершения операции '{active_job.label}'"
+        logger.warning(error_msg)
+        dpg.configure_item(status_tag, default_value=error_msg, color=(255, 165, 0))
+        return True
+    return False
+
+def show_action_error(prefix, e):
+    if isinstance(e, JobCancelled):
+        error_msg = "Операция отменена"
+        logger.warning(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 165, 0))
+        return
+    if isinstance(e, Error):
+        error_msg = f"{prefix}: {e}"
+    else:
+        error_msg = f"Неожиданная ошибка: {str(e)}"
+    logger.error(error_msg)
+    dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+
+# ==================== ОБНОВЛЕНИЯ ИЗ БД (LISTEN/NOTIFY) ====================
+class ChangeListener(threading.Thread):
+    """Поток, слушающий канал NOTIFY на отдельном соединении и передающий изменения в поток GUI."""
+
+    def __init__(self, conn_params):
+        super().__init__(name="db_change_listener", daemon=True)
+        self.conn_params = conn_params
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        conn = None
+        while not self._stop_event.is_set():
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**self.conn_params)
+                    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                    with conn.cursor() as cur:
+                        cur.execute(f'LISTEN {NOTIFY_CONFIG["channel"]};')
+                    logger.info(f"Подписка на канал {NOTIFY_CONFIG['channel']}")
+
+                if select.select([conn], [], [], NOTIFY_CONFIG['poll_timeout']) == ([], [], []):
+                    continue
+                conn.poll()
+                changes = []
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        change = json.loads(notify.payload)
+                    except ValueError:
+                        change = None
+                    if not isinstance(change, dict) or not {'table', 'op', 'id'} <= change.keys():
+                        logger.warning(f"Некорректное уведомление: {notify.payload}")
+                        continue
+                    changes.append(change)
+                # В уведомлении только ключи: строки читаются одним запросом на таблицу
+                db_changes.extend(load_change_rows(conn, changes))
+            except Error as e:
+                logger.error(f"Ошибка слушателя изменений: {e}")
+                if conn is not None and not conn.closed:
+                    conn.close()
+                conn = None
+                self._stop_event.wait(NOTIFY_CONFIG['poll_timeout'] * 5)
+            except Exception:
+                # Ошибка разбора пачки не должна останавливать поток: уведомления теряются, подписка остается
+                logger.exception("Ошибка обработки уведомлений об изменениях")
+        if conn is not None and not conn.closed:
+            conn.close()
+
+def start_change_listener(conn_params):
+    global change_listener
+    stop_change_listener()
+    if NOTIFY_CONFIG['enabled']:
+        change_listener = ChangeListener(conn_params)
+        change_listener.start()
+
+def stop_change_listener():
+    global change_listener
+    if change_listener:
+        change_listener.stop()
+        change_listener = None
+
+def apply_db_changes():
+    # Вызывается каждый кадр: разбирает накопленные изменения в пределах бюджета кадра и применяет
+    # их к панелям одним вызовом apply_panel_changes. Эхо собственных вставок (строка уже в кэше
+    # с теми же данными) пропускается
+    global all_maps
+    if layer_store is None or not db_changes:
+        return
+
+    deadline = time.perf_counter() + FRAME_CONFIG['budget']
+    # Удаления копятся и применяются к кэшу одной пачкой; для Id, измененного несколько раз, берется последняя версия
+    removed_ids = {}
+    added_layers = {}
+    maps_changed = False
+    while db_changes and time.perf_counter() < deadline:
+        change = db_changes.popleft()
+        if change.get('table') == 'Maps':
+            all_maps = [m for m in all_maps if m[0] != change['id']]
+            if change['op'] != 'DELETE':
+                all_maps.append((change['id'], change['name']))
+            maps_changed = True
+            continue
+
+        layer = None
+        if change['op'] != 'DELETE':
+            layer = (change['id'], change['map_id'], change['name'], change['url'], change['type'])
+            if layer[0] not in removed_ids and (layer_store.get(layer[0]) == layer
+                                                or any(view.get(layer[0]) == layer for view in panels.values())):
+                continue
+        removed_ids[change['id']] = None
+        added_layers.pop(change['id'], None)
+        if layer is not None and layer[4] == 'xyz':
+            added_layers[layer[0]] = layer
+
+    if maps_changed:
+        all_maps.sort(key=lambda m: m[1])
+        layer_store.set_maps(all_maps)
+        set_map_combos()
+    if removed_ids:
+        removed_ids = list(removed_ids)
+        added_layers = list(added_layers.values())
+        layer_store.remove_many(removed_ids)
+        layer_store.add(added_layers)
+        apply_panel_changes(removed_ids, added_layers)
+
+def create_unique_layer_index():
+    if not db_pool:
+        logger.error("Нет подключения к БД")
+        return
+
+    if job_busy("action_status_text"):
+        return
+
+    def migrate(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            return ensure_unique_layer_index(conn)
+
+    def done(duplicates):
+        global unique_layer_index
+        if duplicates:
+            for map_id, name, layer_type, count, ids in duplicates:
+                logger.warning(f"Дубликат слоя: MapId={map_id}, Name='{name}', Type={layer_type}, "
+                               f"количество {count}, Id: {ids}")
+            map_id, name, layer_type, count, ids = duplicates[0]
+            msg = (f"Индекс не создан: {len(duplicates)} групп дубликатов "
+                   f"(например, '{name}' в карте {map_id} - {count} шт.), подробности в журнале")
+            logger.warning(msg)
+            dpg.configure_item("action_status_text", default_value=msg, color=(255, 165, 0))
+            return
+
+        unique_layer_index = True
+        msg = "Уникальный индекс слоев создан, копирование использует ON CONFLICT DO NOTHING"
+        logger.info(msg)
+        dpg.configure_item("action_status_text", default_value=msg, color=(0, 255, 0))
+
+    submit_job("Создание уникального индекса", migrate, done,
+               lambda e: show_action_error("Ошибка создания индекса", e))
+
+def create_layer_search_indexes():
+    # Индексы режима 'paged': ключевая пагинация по (MapId, Name, Id) и триграммный поиск по имени
+    if not db_pool:
+        logger.error("Нет подключения к БД")
+        return
+
+    if job_busy("action_status_text"):
+        return
+
+    def create(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            create_browse_indexes(conn)
+
+    def done(_):
+        global trgm_available
+        trgm_available = True
+        msg = "Индексы поиска слоев созданы (pg_trgm)"
+        logger.info(msg)
+        dpg.configure_item("action_status_text", default_value=msg, color=(0, 255, 0))
+
+    submit_job("Создание индексов поиска", create, done,
+               lambda e: show_action_error("Ошибка создания индексов поиска", e))
+
+def install_notify_triggers():
+    if not db_pool:
+        logger.error("Нет подключения к БД")
+        return
+
+    def install(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            with conn.cursor() as cur:
+                log_query(SQL_QUERIES['install_notify_triggers'])
+                cur.execute(SQL_QUERIES['install_notify_triggers'])
+            conn.commit()
+
+    def done(_):
+        msg = "Триггеры уведомлений установлены"
+        logger.info(msg)
+        dpg.configure_item("action_status_text", default_value=msg, color=(0, 255, 0))
+
+    submit_job("Установка триггеров", install, done,
+               lambda e: show_action_error("Ошибка установки триггеров", e))
+
+# ==================== МЕТРИКИ ЗАПРОСОВ ====================
+METRICS_COLUMNS = ("Запрос", "Кол-во", "Ошибки", "p50, мс", "p95, мс", "p99, мс", "max, мс", "Всего, мс",
+                   "Строк", "Отправлено, Б", "Получено, Б")
+
+def show_metrics_window():
+    # Окно метрик открывается поверх остальных и не скрывает их
+    dpg.show_item("metrics_window")
+    dpg.focus_item("metrics_window")
+    refresh_metrics_window()
+
+def refresh_metrics_window():
+    global metrics_refreshed
+    metrics_refreshed = time.monotonic()
+    if not db_core_loaded:
+        return
+
+    dpg.delete_item("metrics_table", children_only=True, slot=1)
+    for key, stats in query_metrics.snapshot().items():
+        with dpg.table_row(parent="metrics_table"):
+            dpg.add_text(key)
+            for value in (stats['count'], stats['errors'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                          stats['max_ms'], stats['total_ms'], stats['rows'], stats['bytes_sent'],
+                          stats['bytes_received']):
+                dpg.add_text(str(value))
+    dpg.set_value("metrics_started_text", f"Сбор с {query_metrics.started:%Y-%m-%d %H:%M:%S}")
+
+def auto_refresh_metrics():
+    # Вызывается из цикла отрисовки: таблица обновляется, только пока окно открыто
+    if (dpg.is_item_shown("metrics_window") and dpg.get_value("metrics_auto_refresh")
+            and time.monotonic() - metrics_refreshed >= METRICS_WINDOW_CONFIG['refresh_interval']):
+        refresh_metrics_window()
+
+def reset_metrics():
+    if not db_core_loaded:
+        return
+    query_metrics.reset()
+    refresh_metrics_window()
+    logger.info("Метрики запросов сброшены")
+
+def export_metrics():
+    if not db_core_loaded:
+        return
+    path = os.path.join(METRICS_WINDOW_CONFIG['export_dir'], f"metrics_{datetime.now():%Y%m%d_%H%M%S}.json")
+    try:
+        query_metrics.export_json(path)
+    except OSError as e:
+        msg = f"Ошибка экспорта метрик: {e}"
+        dpg.set_value("metrics_status_text", msg)
+        logger.error(msg)
+        return
+    msg = f"Метрики сохранены в {os.path.abspath(path)}"
+    dpg.set_value("metrics_status_text", msg)
+    logger.info(msg)
+
+# ==================== СПИСОК СЛОЕВ ПАНЕЛИ ====================
+class PanelView:
+    """Состояние списка слоев панели: слои в порядке отображения, выбранный Id, смещение прокрутки,
+    кэш подписей по Id и содержимое строк таблицы.
+
+    Вставки и удаления применяются как разница (add/remove), а render() меняет только те строки
+    таблицы, содержимое которых изменилось. Фильтр по имени использует NameIndex, который строится
+    в фоне при первом вводе фильтра и дальше обновляется вместе со списком.
+    В панели с отметками (checkable) слои отмечаются флажком, Ctrl+щелчком или Shift+щелчком (диапазон).
+    """
+
+    def __init__(self, panel_side, checkable=False):
+        self.panel_side = panel_side
+        self.checkable = checkable
+        self.map_id = None
+        self.layers = []
+        self.shown = self.layers      # слои, прошедшие фильтр
+        self.filter_text = ""
+        self.index = None             # NameIndex по именам слоев (None - не построен)
+        self.indexing = False
+        self.selected_id = None
+        self.checked = {}             # отмеченные слои: Id -> слой (в режиме 'paged' - и с других страниц)
+        self.anchor_id = None         # начало диапазона для Shift+щелчка
+        # Режим 'paged': в layers только текущая страница с сервера
+        self.paged = False
+        self.page = 0
+        self.total = None
+        self.request = 0              # номер последнего запроса страницы; ответы на прежние отбрасываются
+        self.offset = 0
+        self._positions = {}          # Id -> индекс в layers (None - пересобрать при обращении)
+        self._labels = {}             # Id -> (имя, URL, Id) для ячеек таблицы
+        self._rendered = [None] * LAYER_LIST_CONFIG['visible_rows']
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = {layer[0]: index for index, layer in enumerate(self.layers)}
+        return self._positions
+
+    def set_layers(self, map_id, layers):
+        # Полная замена списка (выбор карты, загрузка слоев); выбор сохраняется, если слой остался
+        if map_id != self.map_id:
+            self._labels.clear()
+            self.offset = 0
+            self.checked.clear()
+        self.map_id = map_id
+        self.layers = layers
+        self.index = None
+        self._positions = None
+        positions = self.positions()
+        if self.selected_id not in positions:
+            self.selected_id = None
+        if not self.paged:
+            for layer_id in [layer_id for layer_id in self.checked if layer_id not in positions]:
+                del self.checked[layer_id]
+
+    def add(self, layers):
+        # Добавляет в конец слои текущей карты, которых еще нет в списке; возвращает их количество
+        positions = self.positions()
+        added = []
+        for layer in layers:
+            if layer[1] == self.map_id and layer[0] not in positions:
+                positions[layer[0]] = len(self.layers)
+                self.layers.append(layer)
+                added.append(layer)
+        if self.index is not None:
+            self.index.add((layer[0], layer[2]) for layer in added)
+        return len(added)
+
+    def remove(self, layer_id):
+        index = self.positions().get(layer_id)
+        if index is None:
+            return False
+        del self.layers[index]
+        self._positions = None
+        self._labels.pop(layer_id, None)
+        if self.index is not None:
+            self.index.remove(layer_id)
+        if self.selected_id == layer_id:
+            self.selected_id = None
+        self.checked.pop(layer_id, None)
+        return True
+
+    def remove_ids(self, layer_ids):
+        # Удаление пачки Id одним проходом по списку (позиции пересобираются один раз)
+        positions = self.positions()
+        present = {layer_id for layer_id in layer_ids if layer_id in positions}
+        if len(present) <= 1:
+            return any([self.remove(layer_id) for layer_id in present])
+        self.layers[:] = [layer for layer in self.layers if layer[0] not in present]
+        self._positions = None
+        for layer_id in present:
+            self._labels.pop(layer_id, None)
+            self.checked.pop(layer_id, None)
+            if self.index is not None:
+                self.index.remove(layer_id)
+        if self.selected_id in present:
+            self.selected_id = None
+        return True
+
+    def label(self, layer):
+        cells = self._labels.get(layer[0])
+        if cells is None:
+            cells = self._labels[layer[0]] = (layer[2], layer[3], str(layer[0]))
+        return cells
+
+    def layer_at_row(self, row):
+        index = self.offset + row
+        return self.shown[index] if index < len(self.shown) else None
+
+    def get(self, layer_id):
+        index = self.positions().get(layer_id)
+        return None if index is None else self.layers[index]
+
+    def click(self, row, toggle=False, extend=False):
+        # Щелчок по строке: выбор слоя; toggle (Ctrl) - переключить отметку,
+        # extend (Shift) - отметить диапазон видимого списка от предыдущего щелчка
+        layer = self.layer_at_row(row)
+        # Selectable сам меняет свое значение при щелчке - строка перерисовывается в любом случае
+        self._rendered[row] = None
+        if layer is None:
+            return None
+        self.selected_id = layer[0]
+        if self.checkable and extend and self.anchor_id is not None:
+            ids = [item[0] for item in self.shown]
+            if self.anchor_id in ids:
+                start, end = sorted((ids.index(self.anchor_id), self.offset + row))
+                for item in self.shown[start:end + 1]:
+                    self.checked[item[0]] = item
+                self.render()
+                return layer
+        if self.checkable and toggle:
+            self.set_checked(layer, layer[0] not in self.checked)
+        self.anchor_id = layer[0]
+        self.render()
+        return layer
+
+    def set_checked(self, layer, checked):
+        if checked:
+            self.checked[layer[0]] = layer
+        else:
+            self.checked.pop(layer[0], None)
+
+    def clear_checked(self):
+        self.checked.clear()
+        self.anchor_id = None
+        self.render()
+
+    def set_filter(self, text):
+        self.filter_text = text.strip()
+        if self.paged:
+            # Поиск выполняется на сервере
+            load_layer_page(self.panel_side, "first")
+            return
+        if self.filter_text and self.index is None and not self.indexing:
+            self.build_index()
+        self.refresh()
+
+    def build_index(self):
+        # Индекс строится в фоновой задаче по снимку списка; изменения за время построения
+        # досчитываются в done()
+        map_id = self.map_id
+        items = [(layer[0], layer[2]) for layer in self.layers]
+        self.indexing = True
+
+        def build(job):
+            return NameIndex(items)
+
+        def done(index):
+            self.indexing = False
+            if self.map_id != map_id:
+                if self.filter_text:
+                    self.build_index()
+                return
+            positions = self.positions()
+            for key in [key for key in index if key not in positions]:
+                index.remove(key)
+            index.add((layer[0], layer[2]) for layer in self.layers if layer[0] not in index)
+            self.index = index
+            self.refresh()
+
+        def failed(e):
+            self.indexing = False
+            logger.error(f"Ошибка построения индекса слоев: {e}")
+
+        submit_job("Индекс слоев", build, done, failed, track=False)
+
+    def _update_shown(self):
+        if self.paged or not self.filter_text:
+            self.shown = self.layers
+        elif self.index is None:
+            self.shown = []
+            if not self.indexing:
+                self.build_index()
+        else:
+            found = self.index.search(self.filter_text)
+            if len(found) * 8 > len(self.layers):
+                # Широкий запрос: проход по списку дешевле сортировки позиций
+                self.shown = [layer for layer in self.layers if layer[0] in found]
+            else:
+                positions = self.positions()
+                self.shown = [self.layers[i] for i in sorted(positions[key] for key in found if key in positions)]
+
+    def scroll(self, offset):
+        max_offset = max(0, len(self.shown) - LAYER_LIST_CONFIG['visible_rows'])
+        self.offset = min(max(offset, 0), max_offset)
+        # У вертикального ползунка максимум вверху, поэтому значение инвертируется
+        dpg.configure_item(f"{self.panel_side}_layers_scroll", max_value=max_offset)
+        dpg.set_value(f"{self.panel_side}_layers_scroll", max_offset - self.offset)
+        self.render()
+
+    def refresh(self):
+        # После изменения списка или фильтра: отбор, ползунок, видимые строки и счетчик
+        self._update_shown()
+        self.scroll(self.offset)
+        if self.paged:
+            dpg.configure_item(f"{self.panel_side}_count_label",
+                               default_value=f"Страница {self.page + 1}, слоев: {self.total or 0}")
+        elif self.filter_text and self.index is None:
+            dpg.configure_item(f"{self.panel_side}_count_label", default_value="Индексирование слоев...")
+        else:
+            update_count_label(self.panel_side, len(self.shown), len(self.layers))
+
+    def render(self):
+        side = self.panel_side
+        for row in range(LAYER_LIST_CONFIG['visible_rows']):
+            layer = self.layer_at_row(row)
+            state = None if layer is None else (layer[0], layer[0] == self.selected_id, layer[0] in self.checked)
+            if self._rendered[row] == state:
+                continue
+            self._rendered[row] = state
+            name, url, layer_id = ("", "", "") if layer is None else self.label(layer)
+            dpg.configure_item(f"{side}_layer_name_{row}", label=name, enabled=layer is not None)
+            dpg.set_value(f"{side}_layer_name_{row}", state is not None and (state[1] or state[2]))
+            dpg.set_value(f"{side}_layer_url_{row}", url)
+            dpg.set_value(f"{side}_layer_id_{row}", layer_id)
+            if self.checkable:
+                dpg.configure_item(f"{side}_layer_check_{row}", show=layer is not None)
+                dpg.set_value(f"{side}_layer_check_{row}", state is not None and state[2])
+        if self.checkable:
+            dpg.set_value(f"{side}_checked_label", f"Отмечено: {len(self.checked)}")
+
+def add_layer_table(panel_side, checkable=False):
+    # Таблица с фиксированным числом строк и вертикальный ползунок прокрутки;
+    # checkable - первый столбец с флажками отметки слоев
+    visible_rows = LAYER_LIST_CONFIG['visible_rows']
+    with dpg.group(horizontal=True):
+        with dpg.table(tag=f"{panel_side}_layers_table", header_row=True, width=405, row_background=True,
+                       borders_innerH=True, policy=dpg.mvTable_SizingStretchProp):
+            if checkable:
+                dpg.add_table_column(label="", init_width_or_weight=0.07)
+            dpg.add_table_column(label="Имя", init_width_or_weight=0.42 if checkable else 0.45)
+            dpg.add_table_column(label="URL", init_width_or_weight=0.41 if checkable else 0.45)
+            dpg.add_table_column(label="ID", init_width_or_weight=0.1)
+            for row in range(visible_rows):
+                with dpg.table_row(height=LAYER_LIST_CONFIG['row_height']):
+                    if checkable:
+                        dpg.add_checkbox(tag=f"{panel_side}_layer_check_{row}", show=False,
+                                         callback=on_layer_check, user_data=(panel_side, row))
+                    dpg.add_selectable(tag=f"{panel_side}_layer_name_{row}", label="", span_columns=True,
+                                       enabled=False, callback=on_layer_select, user_data=(panel_side, row))
+                    dpg.add_text(tag=f"{panel_side}_layer_url_{row}", default_value="")
+                    dpg.add_text(tag=f"{panel_side}_layer_id_{row}", default_value="")
+        dpg.add_slider_int(tag=f"{panel_side}_layers_scroll", vertical=True, min_value=0, max_value=0,
+                           width=18, height=(visible_rows + 1) * LAYER_LIST_CONFIG['row_height'], format="",
+                           callback=on_layer_scroll, user_data=panel_side)
+
+def apply_panel_changes(removed_ids=(), added_layers=()):
+    # Применяет к открытым панелям разницу: удаленные Id и новые слои; каждая панель
+    # перерисовывается один раз и только если ее список изменился
+    for view in panels.values():
+        if view.map_id is None:
+            continue
+        if view.paged:
+            # Страницу с сервера не дополняем на месте (порядок по имени): перечитываем ее
+            if (any(layer[1] == view.map_id for layer in added_layers)
+                    or any(layer_id in view.positions() for layer_id in removed_ids)):
+                load_layer_page(view.panel_side, "reload")
+            continue
+        changed = view.remove_ids(removed_ids)
+        if view.add(added_layers):
+            changed = True
+        if changed:
+            view.refresh()
+
+def on_layers_filter(sender, app_data, user_data):
+    panels[user_data].set_filter(app_data)
+
+def on_layer_scroll(sender, app_data, user_data):
+    panel_side = user_data
+    panels[panel_side].scroll(dpg.get_item_configuration(sender)["max_value"] - app_data)
+
+def on_layers_wheel(sender, app_data):
+    # Колесо мыши прокручивает список той панели, над которой находится курсор;
+    # в режиме 'paged' прокрутка за край страницы загружает соседнюю страницу
+    for panel_side, view in panels.items():
+        if dpg.does_item_exist(f"{panel_side}_panel") and dpg.is_item_hovered(f"{panel_side}_panel"):
+            offset = view.offset - int(app_data) * LAYER_LIST_CONFIG['wheel_rows']
+            max_offset = max(0, len(view.shown) - LAYER_LIST_CONFIG['visible_rows'])
+            if view.paged and offset > max_offset and view.offset == max_offset:
+                load_layer_page(panel_side, "next")
+            elif view.paged and offset < 0 and view.offset == 0 and view.page > 0:
+                load_layer_page(panel_side, "prev")
+            else:
+                view.scroll(offset)
+
+def on_layer_page(sender, app_data, user_data):
+    panel_side, direction = user_data
+    load_layer_page(panel_side, direction)
+
+def load_layer_page(panel_side, direction="first"):
+    # Режим 'paged': страница слоев карты с сервера по ключу ("Name", "Id").
+    # direction: "first" - с начала, "next"/"prev" - соседняя страница, "reload" - текущая заново
+    view = panels[panel_side]
+    map_id = left_panel_selected_map if panel_side == "left" else right_panel_selected_map
+    if not map_id or not db_pool:
+        return
+
+    after = before = None
+    if view.map_id != map_id or not view.layers:
+        if direction in ("next", "prev"):
+            return
+        direction = "first"
+    elif direction == "next":
+        after = (view.layers[-1][2], view.layers[-1][0])
+    elif direction == "prev":
+        before = (view.layers[0][2], view.layers[0][0])
+    elif direction == "reload":
+        # С первой строки страницы включительно: ("Name", "Id") > (имя, Id - 1)
+        after = (view.layers[0][2], view.layers[0][0] - 1)
+
+    view.request += 1
+    request = view.request
+    search = view.filter_text
+    trgm = trgm_available
+    page_size = LOAD_CONFIG['page_size']
+
+    def load(job):
+        restarted = False
+        with db_pool.connection() as conn:
+            job.conn = conn
+            rows = fetch_layer_page(conn, map_id, search, after=after, before=before, trgm=trgm)
+            if direction == "prev" and len(rows) < page_size:
+                # Неполная предыдущая страница - это начало списка
+                rows = fetch_layer_page(conn, map_id, search, trgm=trgm)
+                restarted = True
+            total = count_browse_layers(conn, map_id, search, trgm) if direction in ("first", "reload") else None
+        return rows, total, restarted
+
+    def done(result):
+        if request != view.request:
+            return
+        rows, total, restarted = result
+        if not rows and direction in ("next", "prev"):
+            return
+        if direction == "first" or restarted:
+            view.page = 0
+        elif direction == "next":
+            view.page += 1
+        elif direction == "prev":
+            view.page = max(0, view.page - 1)
+        if direction != "reload":
+            view.offset = 0
+        if total is not None:
+            view.total = total
+        view.set_layers(map_id, rows)
+        view.refresh()
+
+    def failed(e):
+        if request == view.request:
+            show_action_error("Ошибка загрузки страницы слоев", e)
+
+    submit_job("Страница слоев", load, done, failed, track=False)
 
 # ==================== ОСНОВНЫЕ ФУНКЦИИ ====================
 def connect_to_db():
-    global db_connection, all_maps, all_layers
+    if job_busy("db_status_text"):
+        return
+
+    import_db_core()
 
     conn_params = {
         'host': dpg.get_value("host_input") or DB_CONFIG['host'],
@@ -87,37 +907,152 @@ def connect_to_db():
         'user': dpg.get_value("username_input") or DB_CONFIG['user'],
         'password': dpg.get_value("password_input") or DB_CONFIG['password']
     }
+    logger.info(f"Попытка подключения к БД с параметрами: {conn_params}")
+    dpg.configure_item("db_status_text", default_value="Подключение...", color=(255, 255, 255))
+
+    def load(job):
+        pool = DbPool(conn_params)
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                job.conn = conn
+                # Водяной знак берется до загрузки: все, что изменится позже, попадет в следующее обновление
+                log_query(SQL_QUERIES['get_sync_watermark'])
+                cur.execute(SQL_QUERIES['get_sync_watermark'])
+                watermark = cur.fetchone()
+
+                log_query(SQL_QUERIES['get_maps'])
+                cur.execute(SQL_QUERIES['get_maps'])
+                maps = cur.fetchall()
+
+                index_ready = has_unique_layer_index(conn)
+                trgm = has_pg_trgm(conn)
+
+                if LOAD_CONFIG['mode'] == 'preload':
+                    # Оценка числа строк по статистике - только для индикатора прогресса
+                    log_query(SQL_QUERIES['estimate_layers'])
+                    cur.execute(SQL_QUERIES['estimate_layers'])
+                    row = cur.fetchone()
+                    total = row[0] if row else 0
+
+                    store = create_layer_store()
+                    store.load_all([])
+                    stream_layers(conn, SQL_QUERIES['get_layers'], None, store.extend_loaded,
+                                  progress=job.progress, total=total)
+                else:
+                    store = create_layer_store(max_maps=LOAD_CONFIG['map_cache_size'])
+        except Exception:
+            pool.closeall()
+            raise
+        return pool, maps, store, watermark, index_ready, trgm
+
+    submit_job("Подключение", load, on_connected, on_connect_error)
+
+def on_connected(result):
+    global db_pool, all_maps, layer_store, sync_watermark, unique_layer_index, trgm_available
+    if db_pool:
+        db_pool.closeall()
+    db_pool, all_maps, layer_store, sync_watermark, unique_layer_index, trgm_available = result
+    layer_store.set_maps(all_maps)
+    start_change_listener(db_pool.conn_params)
+
+    if not dpg.does_item_exist("main_window"):
+        started = time.perf_counter()
+        create_main_window()
+        logger.info(f"Основное окно построено за {time.perf_counter() - started:.3f} с")
+    set_map_combos()
+    dpg.configure_item("db_status_text", default_value="Подключено успешно", color=(0, 255, 0))
+
+    show_window(None, None, "main_window")
+
+    logger.info(f"Загружено карт: {len(all_maps)}, слоев: {len(layer_store)} (режим {LOAD_CONFIG['mode']}, "
+                f"уникальный индекс слоев: {'есть' if unique_layer_index else 'нет'})")
+
+def on_connect_error(e):
+    if isinstance(e, JobCancelled):
+        error_msg = "Подключение отменено"
+    else:
+        error_msg = f"Ошибка подключения: {e}"
+    logger.error(error_msg)
+    dpg.configure_item("db_status_text", default_value=error_msg, color=(255, 0, 0))
 
-    try:
-        logger.info(f"Попытка подключения к БД с параметрами: {conn_params}")
-
-        conn = psycopg2.connect(**conn_params)
-        db_connection = conn
-
-        with conn.cursor() as cur:
-            log_query(SQL_QUERIES['get_maps'])
-            cur.execute(SQL_QUERIES['get_maps'])
-            all_maps = cur.fetchall()
-
-            log_query(SQL_QUERIES['get_layers'])
-            cur.execute(SQL_QUERIES['get_layers'])
-            all_layers = cur.fetchall()
-
-        map_names = [m[1] for m in all_maps]
-        dpg.configure_item("left_maps_combo", items=map_names)
-        dpg.configure_item("right_maps_combo", items=map_names)
-        dpg.configure_item("db_status_text", default_value="Подключено успешно", color=(0, 255, 0))
-
-        show_window(None, None, "main_window")
+def refresh_data():
+    if job_busy("action_status_text"):
+        return
 
-        logger.info(f"Загружено карт: {len(all_maps)}, слоев: {len(all_layers)}")
-        return True
+    if not db_pool:
+        error_msg = "Нет подключения к БД"
+        logger.error(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+        return
 
-    except OperationalError as e:
-        error_msg = f"Ошибка подключения: {e}"
+    mode = REFRESH_CONFIG['watermark']
+    max_map_id, max_layer_id, xmin = sync_watermark
+    maps_params = (xmin,) if mode == 'xmin' else (max_map_id,)
+    layers_params = (xmin,) if mode == 'xmin' else (max_layer_id,)
+
+    def fetch(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            with conn.cursor() as cur:
+                log_query(SQL_QUERIES['get_sync_watermark'])
+                cur.execute(SQL_QUERIES['get_sync_watermark'])
+                new_watermark = cur.fetchone()
+
+                log_query(SQL_QUERIES[f'get_maps_delta_{mode}'], maps_params)
+                cur.execute(SQL_QUERIES[f'get_maps_delta_{mode}'], maps_params)
+                maps = cur.fetchall()
+
+            layers = []
+            stream_layers(conn, SQL_QUERIES[f'get_layers_delta_{mode}'], layers_params, layers.extend)
+        return new_watermark, maps, layers
+
+    def done(result):
+        global all_maps, sync_watermark
+        new_watermark, maps, layers = result
+
+        if maps:
+            changed = {m[0] for m in maps}
+            all_maps = sorted([m for m in all_maps if m[0] not in changed] + maps, key=lambda m: m[1])
+            layer_store.set_maps(all_maps)
+            set_map_combos()
+
+        # Строки дельты применяются по кадрам тем же путем, что и уведомления NOTIFY (apply_db_changes):
+        # строки, уже лежащие в кэше с теми же данными, пропускаются, удаления идут пачкой
+        db_changes.extend({'table': 'Layers', 'op': 'UPDATE', 'id': layer[0], 'map_id': layer[1],
+                           'name': layer[2], 'url': layer[3], 'type': layer[4]} for layer in layers)
+
+        # Водяной знак не откатываем назад (max Id мог уменьшиться после удалений)
+        sync_watermark = (max(max_map_id, new_watermark[0]), max(max_layer_id, new_watermark[1]),
+                          new_watermark[2])
+
+        msg = f"Обновлено: карт {len(maps)}, слоев {len(layers)}"
+        logger.info(msg)
+        dpg.configure_item("action_status_text", default_value=msg, color=(0, 255, 0))
+
+    submit_job("Обновление данных", fetch, done, lambda e: show_action_error("Ошибка при обновлении", e))
+
+def load_map_layers(panel_side, map_id):
+    def load(job):
+        layers = []
+        with db_pool.connection() as conn:
+            job.conn = conn
+            stream_layers(conn, SQL_QUERIES['get_map_layers'], (map_id,), layers.extend)
+        return layers
+
+    def done(layers):
+        layer_store.set_map_layers(map_id, layers, pinned=(left_panel_selected_map, right_panel_selected_map))
+        logger.info(f"Загружены слои карты {map_id}: {len(layers)}")
+        for side, selected_map_id in (("left", left_panel_selected_map), ("right", right_panel_selected_map)):
+            if selected_map_id == map_id:
+                update_layers_list(side)
+
+    def failed(e):
+        error_msg = f"Ошибка загрузки слоев карты: {e}"
         logger.error(error_msg)
-        dpg.configure_item("db_status_text", default_value=error_msg, color=(255, 0, 0))
-        return False
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+
+    dpg.configure_item(f"{panel_side}_count_label", default_value="Загрузка слоев...")
+    submit_job("Загрузка слоев карты", load, done, failed, track=False)
 
 def update_layers_list(panel_side, map_id=None):
     if map_id is None:
@@ -126,56 +1061,62 @@ def update_layers_list(panel_side, map_id=None):
     if not map_id:
         return
 
-    layers = [layer for layer in all_layers if layer[1] == map_id]
-    current_layers[panel_side] = layers
-    items = [f"{layer[2]} ({layer[3]}) [ID: {layer[0]}]" for layer in layers]
-    dpg.configure_item(f"{panel_side}_layers_listbox", items=items)
-    selected_layers[panel_side] = None
-    update_count_label(panel_side, len(layers))
-    logger.info(f"Обновлен список слоев для {panel_side} панели (map_id={map_id}), количество: {len(layers)}")
+    if panels[panel_side].paged:
+        load_layer_page(panel_side, "first")
+        return
+
+    if not layer_store.is_loaded(map_id):
+        load_map_layers(panel_side, map_id)
+        return
+
+    layers = layer_store.layers_for_map(map_id)
+    panels[panel_side].set_layers(map_id, layers)
+    panels[panel_side].refresh()
+    ui_logger.info("Обновлен список слоев для %s панели (map_id=%s), количество: %d", panel_side, map_id, len(layers))
 
 def on_map_select(sender, app_data, user_data):
     panel_side = user_data
     selected_map_name = app_data
 
-    selected_map = next((m for m in all_maps if m[1] == selected_map_name), None)
-    if not selected_map:
+    selected_map_id = layer_store.map_id_by_name(selected_map_name)
+    if selected_map_id is None:
         return
 
     if panel_side == "left":
         global left_panel_selected_map
-        left_panel_selected_map = selected_map[0]
+        left_panel_selected_map = selected_map_id
         update_layers_list("left")
     else:
         global right_panel_selected_map
-        right_panel_selected_map = selected_map[0]
+        right_panel_selected_map = selected_map_id
         update_layers_list("right")
 
 def on_layer_select(sender, app_data, user_data):
-    panel_side = user_data
-    try:
-        selected_item = dpg.get_value(sender)  # Получаем строковое значение элемента
-        # Находим индекс выбранного элемента в списке
-        items = dpg.get_item_configuration(sender)["items"]
-        selected_index = items.index(selected_item) if selected_item in items else None
-        selected_layers[panel_side] = selected_index
-        logger.info(f"Выбран слой в {panel_side} панели: {selected_item}, индекс: {selected_index}")
-    except Exception as e:
-        logger.error(f"Ошибка при выборе слоя в {panel_side} панели: {e}")
-        selected_layers[panel_side] = None
-
-def check_layer_exists(map_id, name, layer_type):
-    try:
-        with db_connection.cursor() as cur:
-            log_query(SQL_QUERIES['check_layer_exists'], (map_id, name, layer_type))
-            cur.execute(SQL_QUERIES['check_layer_exists'], (map_id, name, layer_type))
-            return cur.fetchone() is not None
-    except Error as e:
-        logger.error(f"Ошибка при проверке слоя: {e}")
-        return False
+    # Строка таблицы -> слой по смещению прокрутки; выбор запоминается по Id слоя.
+    # Ctrl+щелчок отмечает слой, Shift+щелчок - диапазон (в панели с отметками)
+    panel_side, row = user_data
+    layer = panels[panel_side].click(row, toggle=dpg.is_key_down(dpg.mvKey_ModCtrl),
+                                     extend=dpg.is_key_down(dpg.mvKey_ModShift))
+    if layer:
+        ui_logger.info("Выбран слой в %s панели: %s, Id: %s", panel_side, layer[2], layer[0])
+
+def on_layer_check(sender, app_data, user_data):
+    panel_side, row = user_data
+    view = panels[panel_side]
+    layer = view.layer_at_row(row)
+    if layer:
+        view.set_checked(layer, app_data)
+        view.anchor_id = layer[0]
+        view.render()
+
+def on_clear_checked(sender, app_data, user_data):
+    panels[user_data].clear_checked()
 
 def move_layer_to_right():
-    if not db_connection:
+    if job_busy("action_status_text"):
+        return
+
+    if not db_pool:
         error_msg = "Нет подключения к БД"
         logger.error(error_msg)
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
@@ -187,104 +1128,142 @@ def move_layer_to_right():
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
         return
 
-    if selected_layers["left"] is None:
+    if panels["left"].selected_id is None:
         error_msg = "Выберите слой для копирования"
         logger.warning(error_msg)
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
         return
 
-    try:
-        selected_index = selected_layers["left"]
-        source_layers = current_layers["left"]
+    selected_id = panels["left"].selected_id
+    selected_layer = panels["left"].get(selected_id)
+    logger.info(f"Попытка копирования слоя с Id {selected_id}")
 
-        logger.info(f"Попытка копирования слоя с индексом {selected_index}, список слоев: {len(source_layers)}")
+    if selected_layer is None or selected_layer[1] != left_panel_selected_map:
+        error_msg = f"Выбранный слой не найден в исходной карте (Id {selected_id})"
+        logger.error(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+        panels["left"].selected_id = None
+        return
 
-        if selected_index is None or not isinstance(selected_index, int) or selected_index >= len(source_layers):
-            error_msg = f"Неверный индекс выбранного слоя: {selected_index}"
-            logger.error(error_msg)
-            dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
-            return
+    dst_map_id = right_panel_selected_map
+    logger.info(f"Выбран слой для копирования: {selected_layer}")
+
+    if layer_store.contains(dst_map_id, selected_layer[2], selected_layer[4]):
+        error_msg = f"Слой '{selected_layer[2]}' уже существует в целевой карте"
+        logger.warning(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 165, 0))
+        return
 
-        selected_layer = source_layers[selected_index]
-        logger.info(f"Выбран слой для копирования: {selected_layer}")
+    on_conflict = unique_layer_index
 
-        if check_layer_exists(right_panel_selected_map, selected_layer[2], selected_layer[4]):
+    def copy(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            return copy_layer(conn, dst_map_id, selected_layer, on_conflict)
+
+    def done(new_id):
+        if new_id is None:
             error_msg = f"Слой '{selected_layer[2]}' уже существует в целевой карте"
             logger.warning(error_msg)
             dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 165, 0))
             return
 
-        # Формируем GroupLayer: если Name содержит кириллицу, транслитерируем в латиницу
-        layer_name = selected_layer[2]
-        # Проверяем, содержит ли имя кириллические символы
-        if any(0x0400 <= ord(char) <= 0x04FF for char in layer_name):
-            try:
-                group_layer_name = translit(layer_name, 'ru', reversed=True)
-                logger.info(f"Имя слоя '{layer_name}' транслитерировано в '{group_layer_name}'")
-            except Exception as e:
-                logger.error(f"Ошибка транслитерации для '{layer_name}': {e}")
-                group_layer_name = layer_name  # Используем оригинальное имя в случае ошибки
-        else:
-            group_layer_name = layer_name
-        group_layer = f"BACKGROUND:{group_layer_name}"
-
-        with db_connection.cursor() as cur:
-            # Параметры для INSERT
-            params = (
-                right_panel_selected_map,  # MapId
-                selected_layer[2],        # Name
-                selected_layer[3],        # Url
-                selected_layer[4],        # Type
-                None,                     # IsActive
-                False,                    # IsExpanded
-                1.0,                      # DefaultOpacity
-                2,                        # LayerOrder
-                True,                     # IsBaseMap
-                False,                    # IsDeleted
-                False,                    # IsSnappable
-                False,                    # IsUnsearchable
-                group_layer,              # GroupLayer (с транслитерацией, если нужно)
-                False,                    # IsReestr
-                False                     # IsService
-            )
-            log_query(SQL_QUERIES['insert_layer'], params)
-            cur.execute(SQL_QUERIES['insert_layer'], params)
-            new_id = cur.fetchone()[0]
-
-            # Обновляем all_layers только с полями, соответствующими get_layers
-            all_layers.append((
-                new_id,
-                right_panel_selected_map,
-                selected_layer[2],
-                selected_layer[3],
-                selected_layer[4]
-            ))
-            db_connection.commit()
-
-            success_msg = f"Слой '{selected_layer[2]}' успешно скопирован (новый ID: {new_id})"
-            logger.info(success_msg)
+        # Обновляем кэш слоев только с полями, соответствующими get_layers
+        new_layer = (
+            new_id,
+            dst_map_id,
+            selected_layer[2],
+            selected_layer[3],
+            selected_layer[4]
+        )
+        layer_store.add([new_layer])
 
-            update_layers_list("right")
-            dpg.configure_item("action_status_text",
-                             default_value=success_msg,
-                             color=(0, 255, 0))
+        success_msg = f"Слой '{selected_layer[2]}' успешно скопирован (новый ID: {new_id})"
+        logger.info(success_msg)
 
-    except Error as e:
-        db_connection.rollback()
-        error_msg = f"Ошибка при копировании: {e}"
-        logger.error(error_msg)
+        apply_panel_changes(added_layers=[new_layer])
         dpg.configure_item("action_status_text",
-                         default_value=error_msg,
-                         color=(255, 0, 0))
-    except Exception as e:
-        error_msg = f"Неожиданная ошибка: {str(e)}"
+                         default_value=success_msg,
+                         color=(0, 255, 0))
+
+    submit_job("Копирование слоя", copy, done, lambda e: show_action_error("Ошибка при копировании", e))
+
+def move_checked_layers_to_right():
+    # Отмеченные слои левой панели копируются одной транзакцией: одна проверка существующих
+    # слоев и одна пакетная вставка; результат по каждому слою - в окне отчета
+    if job_busy("action_status_text"):
+        return
+
+    if not db_pool:
+        error_msg = "Нет подключения к БД"
         logger.error(error_msg)
-        dpg.configure_item("action_status_text",
-                         default_value=error_msg,
-                         color=(255, 0, 0))
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+        return
+
+    if not left_panel_selected_map or not right_panel_selected_map:
+        error_msg = "Выберите карты в обеих панелях"
+        logger.warning(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+        return
+
+    source_layers = [layer for layer in panels["left"].checked.values() if layer[1] == left_panel_selected_map]
+    if not source_layers:
+        error_msg = "Отметьте слои для копирования (флажок, Ctrl или Shift + щелчок)"
+        logger.warning(error_msg)
+        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+        return
+
+    dst_map_id = right_panel_selected_map
+    on_conflict = unique_layer_index
+    logger.info(f"Копирование отмеченных слоев ({len(source_layers)}) в карту {dst_map_id}")
+
+    def copy(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            return copy_layers(conn, dst_map_id, source_layers, on_conflict=on_conflict)
+
+    def done(report):
+        new_layers = [new_layer for _, status, new_layer in report if status == 'copied']
+        layer_store.add(new_layers)
+        apply_panel_changes(added_layers=new_layers)
+        panels["left"].clear_checked()
+
+        skipped_count = len(report) - len(new_layers)
+        show_copy_report(dst_map_id, report)
+        if new_layers:
+            success_msg = f"Скопировано {len(new_layers)} из {len(report)} отмеченных слоев, пропущено {skipped_count}"
+            logger.info(success_msg)
+            dpg.configure_item("action_status_text", default_value=success_msg, color=(0, 255, 0))
+        else:
+            warning_msg = f"Все отмеченные слои ({skipped_count}) уже существуют в целевой карте"
+            logger.warning(warning_msg)
+            dpg.configure_item("action_status_text", default_value=warning_msg, color=(255, 165, 0))
+
+    submit_job("Копирование отмеченных слоев", copy, done,
+               lambda e: show_action_error("Ошибка при копировании отмеченных слоев", e))
+
+def show_copy_report(dst_map_id, report):
+    # Окно отчета: результат копирования по каждому слою
+    map_name = next((name for map_id, name in all_maps if map_id == dst_map_id), dst_map_id)
+    copied = sum(1 for _, status, _ in report if status == 'copied')
+    dpg.set_value("copy_report_summary",
+                  f"Карта '{map_name}': скопировано {copied}, пропущено {len(report) - copied}")
+    dpg.delete_item("copy_report_table", children_only=True, slot=1)
+    for layer, status, new_layer in report:
+        logger.info(f"Слой '{layer[2]}' (Id {layer[0]}): {COPY_REPORT_STATUS[status]}")
+        with dpg.table_row(parent="copy_report_table"):
+            dpg.add_text(layer[2])
+            dpg.add_text(str(layer[0]))
+            dpg.add_text(COPY_REPORT_STATUS[status])
+            dpg.add_text(str(new_layer[0]) if new_layer else "")
+    dpg.show_item("copy_report_window")
+    dpg.focus_item("copy_report_window")
 
 def move_all_layers_to_right():
-    if not db_connection:
+    if job_busy("action_status_text"):
+        return
+
+    if not db_pool:
         error_msg = "Нет подключения к БД"
         logger.error(error_msg)
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
@@ -296,72 +1275,39 @@ def move_all_layers_to_right():
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
         return
 
-    if not current_layers["left"]:
+    src_map_id = left_panel_selected_map
+    dst_map_id = right_panel_selected_map
+    # Панель может еще показывать слои предыдущей карты (ленивая загрузка не завершена или не удалась),
+    # а в режиме 'paged' в ней только страница: тогда слои исходной карты читаются с сервера в задаче
+    stream = panels["left"].paged or panels["left"].map_id != src_map_id
+    source_layers = [] if stream else list(panels["left"].layers)
+
+    if not stream and not source_layers:
         error_msg = "В левой панели нет слоев для копирования"
         logger.warning(error_msg)
         dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
         return
 
-    try:
-        copied_count = 0
-        skipped_count = 0
-        for selected_layer in current_layers["left"]:
-            logger.info(f"Обработка слоя для копирования: {selected_layer}")
-
-            if check_layer_exists(right_panel_selected_map, selected_layer[2], selected_layer[4]):
-                logger.warning(f"Слой '{selected_layer[2]}' уже существует в целевой карте, пропускаем")
-                skipped_count += 1
-                continue
-
-            # Формируем GroupLayer: если Name содержит кириллицу, транслитерируем в латиницу
-            layer_name = selected_layer[2]
-            if any(0x0400 <= ord(char) <= 0x04FF for char in layer_name):
-                try:
-                    group_layer_name = translit(layer_name, 'ru', reversed=True)
-                    logger.info(f"Имя слоя '{layer_name}' транслитерировано в '{group_layer_name}'")
-                except Exception as e:
-                    logger.error(f"Ошибка транслитерации для '{layer_name}': {e}")
-                    group_layer_name = layer_name
-            else:
-                group_layer_name = layer_name
-            group_layer = f"BACKGROUND:{group_layer_name}"
-
-            with db_connection.cursor() as cur:
-                params = (
-                    right_panel_selected_map,  # MapId
-                    selected_layer[2],        # Name
-                    selected_layer[3],        # Url
-                    selected_layer[4],        # Type
-                    None,                     # IsActive
-                    False,                    # IsExpanded
-                    1.0,                      # DefaultOpacity
-                    2,                        # LayerOrder
-                    True,                     # IsBaseMap
-                    False,                    # IsDeleted
-                    False,                    # IsSnappable
-                    False,                    # IsUnsearchable
-                    group_layer,              # GroupLayer
-                    False,                    # IsReestr
-                    False                     # IsService
-                )
-                log_query(SQL_QUERIES['insert_layer'], params)
-                cur.execute(SQL_QUERIES['insert_layer'], params)
-                new_id = cur.fetchone()[0]
-
-                # Обновляем all_layers
-                all_layers.append((
-                    new_id,
-                    right_panel_selected_map,
-                    selected_layer[2],
-                    selected_layer[3],
-                    selected_layer[4]
-                ))
-                db_connection.commit()
-
-                logger.info(f"Слой '{selected_layer[2]}' успешно скопирован (новый ID: {new_id})")
-                copied_count += 1
-
-        update_layers_list("right")
+    on_conflict = unique_layer_index
+
+    def copy_all(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            if stream:
+                stream_layers(conn, SQL_QUERIES['get_map_layers'], (src_map_id,), source_layers.extend)
+            job.progress(0, len(source_layers))
+            if COPY_CONFIG['mode'] == 'batch':
+                return batch_copy_layers(conn, dst_map_id, source_layers, progress=job.progress,
+                                         on_conflict=on_conflict)
+            return bulk_copy_layers(conn, src_map_id, dst_map_id, source_layers, on_conflict)
+
+    def done(result):
+        new_layers, skipped_count = result
+        layer_store.add(new_layers)
+        copied_count = len(new_layers)
+
+        # Одно обновление панели на всю операцию, O(скопированных слоев)
+        apply_panel_changes(added_layers=new_layers)
         if copied_count > 0:
             success_msg = f"Скопировано {copied_count} слоев, пропущено {skipped_count}"
             logger.info(success_msg)
@@ -371,18 +1317,222 @@ def move_all_layers_to_right():
             logger.warning(warning_msg)
             dpg.configure_item("action_status_text", default_value=warning_msg, color=(255, 165, 0))
 
-    except Error as e:
-        db_connection.rollback()
-        error_msg = f"Ошибка при массовом копировании: {e}"
-        logger.error(error_msg)
-        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
-    except Exception as e:
-        error_msg = f"Неожиданная ошибка: {str(e)}"
-        logger.error(error_msg)
-        dpg.configure_item("action_status_text", default_value=error_msg, color=(255, 0, 0))
+    submit_job("Копирование всех слоев", copy_all, done,
+               lambda e: show_action_error("Ошибка при массовом копировании", e))
+
+# ==================== КОПИРОВАНИЕ В НЕСКОЛЬКО КАРТ ====================
+def show_fanout_window():
+    if not db_core_loaded or maps_index is None:
+        logger.error("Нет подключения к БД")
+        return
+    source = next((name for map_id, name in all_maps if map_id == left_panel_selected_map), None)
+    dpg.set_value("fanout_source_text", f"Исходная карта: {source}" if source else
+                  "Исходная карта: выберите карту в левой панели")
+    filter_fanout_maps()
+    dpg.show_item("fanout_window")
+    dpg.focus_item("fanout_window")
+
+def found_fanout_maps():
+    text = dpg.get_value("fanout_maps_filter")
+    found = maps_index.search(text) if text else None
+    return [m for m in all_maps if found is None or m[0] in found]
+
+def filter_fanout_maps(sender=None, app_data=None, user_data=None):
+    # Список карт с флажками перестраивается по фильтру; показывается не больше max_shown карт
+    maps = found_fanout_maps()
+    shown = maps[:FANOUT_CONFIG['max_shown']]
+    dpg.delete_item("fanout_maps_list", children_only=True)
+    for map_id, name in shown:
+        dpg.add_checkbox(label=f"{name} (Id {map_id})", parent="fanout_maps_list",
+                         default_value=map_id in fanout_targets, callback=on_fanout_check, user_data=map_id)
+    if len(maps) > len(shown):
+        dpg.add_text(f"... и еще {len(maps) - len(shown)} карт, уточните фильтр", parent="fanout_maps_list")
+    update_fanout_label()
+
+def update_fanout_label():
+    dpg.set_value("fanout_checked_label", f"Отмечено карт: {len(fanout_targets)}")
+
+def on_fanout_check(sender, app_data, user_data):
+    if app_data:
+        fanout_targets.add(user_data)
+    else:
+        fanout_targets.discard(user_data)
+    update_fanout_label()
+
+def check_found_fanout_maps(sender, app_data, user_data):
+    # user_data: True - отметить все найденные фильтром карты, False - снять все отметки
+    if user_data:
+        fanout_targets.update(m[0] for m in found_fanout_maps())
+    else:
+        fanout_targets.clear()
+    filter_fanout_maps()
+
+def fanout_copy_to_maps():
+    # Все xyz-слои исходной карты копируются во все отмеченные карты одним запросом в одной транзакции;
+    # при нескольких соединениях - партициями по MapId параллельно (parallel_fanout_copy)
+    if job_busy("fanout_status_text"):
+        return
+
+    if not db_pool:
+        dpg.configure_item("fanout_status_text", default_value="Нет подключения к БД", color=(255, 0, 0))
+        return
+
+    src_map_id = left_panel_selected_map
+    dst_map_ids = sorted(map_id for map_id in fanout_targets if map_id != src_map_id)
+    if not src_map_id or not dst_map_ids:
+        error_msg = "Выберите исходную карту в левой панели и отметьте целевые карты"
+        logger.warning(error_msg)
+        dpg.configure_item("fanout_status_text", default_value=error_msg, color=(255, 0, 0))
+        return
+
+    paged = panels["left"].paged or panels["left"].map_id != src_map_id
+    source_layers = [] if paged else list(panels["left"].layers)
+    on_conflict = unique_layer_index
+    workers = max(1, dpg.get_value("fanout_workers"))
+    logger.info(f"Копирование слоев карты {src_map_id} в {len(dst_map_ids)} карт (соединений: {workers})")
+
+    def copy(job):
+        with db_pool.connection() as conn:
+            job.conn = conn
+            if paged:
+                stream_layers(conn, SQL_QUERIES['get_map_layers'], (src_map_id,), source_layers.extend)
+            if workers == 1:
+                return fanout_copy_layers(conn, src_map_id, dst_map_ids, source_layers, on_conflict) + ([],)
+        # Отмена прерывает задачу между партициями (job.progress)
+        job.conn = None
+        return parallel_fanout_copy(db_pool.conn_params, src_map_id, dst_map_ids, source_layers, workers,
+                                    progress=job.progress, on_conflict=on_conflict)
+
+    def done(result):
+        new_layers, report, failed = result
+        layer_store.add(new_layers)
+        apply_panel_changes(added_layers=new_layers)
+
+        names = dict(all_maps)
+        dpg.delete_item("fanout_report_table", children_only=True, slot=1)
+        for map_id, (copied_count, skipped_count) in report.items():
+            logger.info(f"Карта '{names.get(map_id, map_id)}': скопировано {copied_count}, пропущено {skipped_count}")
+            with dpg.table_row(parent="fanout_report_table"):
+                dpg.add_text(names.get(map_id, str(map_id)))
+                dpg.add_text(str(copied_count))
+                dpg.add_text(str(skipped_count))
+        for map_id in failed:
+            with dpg.table_row(parent="fanout_report_table"):
+                dpg.add_text(names.get(map_id, str(map_id)))
+                dpg.add_text("ошибка")
+                dpg.add_text("")
+
+        msg = f"Скопировано {len(new_layers)} слоев в {sum(1 for c, _ in report.values() if c)} из {len(report)} карт"
+        if failed:
+            msg += f", не выполнено для {len(failed)} карт (см. журнал)"
+            logger.error(msg)
+            dpg.configure_item("fanout_status_text", default_value=msg, color=(255, 0, 0))
+            return
+        logger.info(msg)
+        dpg.configure_item("fanout_status_text", default_value=msg, color=(0, 255, 0) if new_layers else (255, 165, 0))
+
+    submit_job("Копирование в несколько карт", copy, done,
+               lambda e: show_action_error("Ошибка при копировании в несколько карт", e))
 
 # ==================== ГЛАВНЫЙ ИНТЕРФЕЙС ====================
-def create_gui():
+def create_main_window():
+    # Основное окно работы со слоями
+    panels.update({"left": PanelView("left", checkable=True), "right": PanelView("right")})
+    paged = LOAD_CONFIG['mode'] == 'paged'
+    for view in panels.values():
+        view.paged = paged
+    with dpg.window(label="Работа со слоями", tag="main_window", show=False, width=1920, height=1080):
+        dpg.add_text("ЛЕВАЯ ПАНЕЛЬ: исходные данные | ПРАВАЯ ПАНЕЛЬ: целевая карта", indent=250)
+        with dpg.group(horizontal=True):
+            # Левая панель (исходные данные)
+            with dpg.child_window(tag="left_panel", width=450, height=600):
+                dpg.add_text("Исходная карта:")
+                dpg.add_input_text(tag="left_maps_filter", hint="Фильтр карт", width=340,
+                                   callback=on_maps_filter, user_data="left")
+                with dpg.group(horizontal=True):
+                    dpg.add_combo(tag="left_maps_combo", items=[], width=340, callback=on_map_select,
+                                  user_data="left")
+                    dpg.add_button(label="Обновить", width=82, callback=refresh_data)
+                dpg.add_spacer(height=10)
+                dpg.add_text("Слои выбранной карты:")
+                dpg.add_input_text(tag="left_layers_filter", hint="Фильтр слоев (имя, в т.ч. транслитом)",
+                                   width=405, callback=on_layers_filter, user_data="left")
+                add_layer_table("left", checkable=True)
+                with dpg.group(horizontal=True, show=paged):
+                    dpg.add_button(label="< Назад", width=100, callback=on_layer_page, user_data=("left", "prev"))
+                    dpg.add_button(label="Вперед >", width=100, callback=on_layer_page, user_data=("left", "next"))
+                dpg.add_text(tag="left_count_label", default_value="Количество: 0")
+                with dpg.group(horizontal=True):
+                    dpg.add_text(tag="left_checked_label", default_value="Отмечено: 0")
+                    dpg.add_button(label="Снять отметки", width=120, callback=on_clear_checked, user_data="left")
+
+            # Центральная панель с кнопками
+            with dpg.group(horizontal=False):
+                dpg.add_spacer(height=50)
+                dpg.add_button(
+                    label="→ Копировать в карту →",
+                    width=250,
+                    height=50,
+                    callback=move_layer_to_right
+                )
+                dpg.add_spacer(height=20)
+                dpg.add_button(
+                    label="→ Копировать отмеченные →",
+                    width=250,
+                    height=50,
+                    callback=move_checked_layers_to_right
+                )
+                dpg.add_spacer(height=20)
+                dpg.add_button(
+                    label="→ Копировать все слои →",
+                    width=250,
+                    height=50,
+                    callback=move_all_layers_to_right
+                )
+                dpg.add_spacer(height=20)
+                dpg.add_button(
+                    label="→ Копировать в несколько карт →",
+                    width=250,
+                    height=50,
+                    callback=show_fanout_window
+                )
+                dpg.add_spacer(height=20)
+                dpg.add_text(tag="action_status_text", default_value="", indent=50)
+
+            # Правая панель (целевая карта)
+            with dpg.child_window(tag="right_panel", width=450, height=600):
+                dpg.add_text("Целевая карта:")
+                dpg.add_input_text(tag="right_maps_filter", hint="Фильтр карт", width=340,
+                                   callback=on_maps_filter, user_data="right")
+                with dpg.group(horizontal=True):
+                    dpg.add_combo(tag="right_maps_combo", items=[], width=340, callback=on_map_select,
+                                  user_data="right")
+                    dpg.add_button(label="Обновить", width=82, callback=refresh_data)
+                dpg.add_spacer(height=10)
+                dpg.add_text("Слои выбранной карты:")
+                dpg.add_input_text(tag="right_layers_filter", hint="Фильтр слоев (имя, в т.ч. транслитом)",
+                                   width=405, callback=on_layers_filter, user_data="right")
+                add_layer_table("right")
+                with dpg.group(horizontal=True, show=paged):
+                    dpg.add_button(label="< Назад", width=100, callback=on_layer_page, user_data=("right", "prev"))
+                    dpg.add_button(label="Вперед >", width=100, callback=on_layer_page, user_data=("right", "next"))
+                dpg.add_text(tag="right_count_label", default_value="Количество: 0")
+
+
+def print_startup_profile():
+    total = time.perf_counter() - _import_started
+    print("=" * 50)
+    print("Профиль запуска:")
+    for stage, seconds in STARTUP_PROFILE:
+        print(f"  {stage:<35} {seconds * 1000:8.1f} мс")
+    print(f"  {'всего до окна подключения':<35} {total * 1000:8.1f} мс")
+    print("=" * 50)
+
+def create_gui(profile_startup=False):
+    global job_executor
+    started = time.perf_counter()
+    job_executor = ThreadPoolExecutor(max_workers=JOB_CONFIG['max_workers'], thread_name_prefix="db_job")
+
     dpg.create_context()
     dpg.create_viewport(title='Управление слоями карт', width=1920, height=1080)
     dpg.maximize_viewport()
@@ -443,88 +1593,141 @@ def create_gui():
         with dpg.menu(label="Окна"):
             dpg.add_menu_item(label="Подключение к БД", callback=show_window, user_data="connection_window")
             dpg.add_menu_item(label="Работа со слоями", callback=show_window, user_data="main_window")
+            dpg.add_menu_item(label="Метрики запросов", callback=show_metrics_window)
+            dpg.add_menu_item(label="Копирование в несколько карт", callback=show_fanout_window)
+        with dpg.menu(label="База данных"):
+            dpg.add_menu_item(label="Установить триггеры уведомлений", callback=install_notify_triggers)
+            dpg.add_menu_item(label="Создать уникальный индекс слоев", callback=create_unique_layer_index)
+            dpg.add_menu_item(label="Создать индексы поиска слоев (pg_trgm)", callback=create_layer_search_indexes)
         dpg.add_menu_item(label="Полный экран", callback=toggle_fullscreen)
 
     # Окно подключения к БД
     with dpg.window(label="Подключение к БД", tag="connection_window", width=600, height=400):
         with dpg.group(horizontal=True):
             with dpg.group(width=300):
-                dpg.add_input_text(label="Хост", tag="host_input", default_value=DB_CONFIG['host'], width=250)
-                dpg.add_input_text(label="Порт", tag="port_input", default_value=DB_CONFIG['port'], width=250)
-                dpg.add_input_text(label="База данных", tag="dbname_input", default_value=DB_CONFIG['dbname'],
+                dpg.add_input_text(label="Хост", tag="host_input", default_value="", width=250)
+                dpg.add_input_text(label="Порт", tag="port_input", default_value="", width=250)
+                dpg.add_input_text(label="База данных", tag="dbname_input", default_value="",
                                    width=250)
             with dpg.group(width=300):
-                dpg.add_input_text(label="Пользователь", tag="username_input", default_value=DB_CONFIG['user'],
+                dpg.add_input_text(label="Пользователь", tag="username_input", default_value="",
                                    width=250)
-                dpg.add_input_text(label="Пароль", tag="password_input", default_value=DB_CONFIG['password'],
+                dpg.add_input_text(label="Пароль", tag="password_input", default_value="",
                                    password=True, width=250)
                 dpg.add_button(label="Подключиться", callback=connect_to_db, width=250)
         dpg.add_text(tag="db_status_text", default_value="")
 
-    # Основное окно работы со слоями
-    with dpg.window(label="Работа со слоями", tag="main_window", show=False, width=1920, height=1080):
-        dpg.add_text("ЛЕВАЯ ПАНЕЛЬ: исходные данные | ПРАВАЯ ПАНЕЛЬ: целевая карта", indent=250)
-        with dpg.group(horizontal=True):
-            # Левая панель (исходные данные)
-            with dpg.child_window(width=450, height=550):
-                dpg.add_text("Исходная карта:")
-                dpg.add_combo(tag="left_maps_combo", items=[], width=430, callback=on_map_select, user_data="left")
-                dpg.add_spacer(height=10)
-                dpg.add_text("Слои выбранной карты:")
-                dpg.add_listbox(tag="left_layers_listbox", items=[], num_items=15, width=430,
-                                callback=on_layer_select, user_data="left")
-                dpg.add_text(tag="left_count_label", default_value="Количество: 0")
+    # Окно прогресса фоновой задачи
+    with dpg.window(label="Выполнение операции", tag="job_window", show=False, no_close=True,
+                    width=600, height=110, pos=(660, 600)):
+        dpg.add_progress_bar(tag="job_progress_bar", default_value=0.0, width=580)
+        dpg.add_button(label="Отменить", tag="job_cancel_button", width=150, callback=cancel_active_job)
 
-            # Центральная панель с кнопками
-            with dpg.group(horizontal=False):
-                dpg.add_spacer(height=50)
-                dpg.add_button(
-                    label="→ Копировать в карту →",
-                    width=250,
-                    height=50,
-                    callback=move_layer_to_right
-                )
-                dpg.add_spacer(height=20)
-                dpg.add_button(
-                    label="→ Копировать все слои →",
-                    width=250,
-                    height=50,
-                    callback=move_all_layers_to_right
-                )
-                dpg.add_spacer(height=20)
-                dpg.add_text(tag="action_status_text", default_value="", indent=50)
+    # Прокрутка списков слоев колесом мыши
+    with dpg.handler_registry():
+        dpg.add_mouse_wheel_handler(callback=on_layers_wheel)
 
-            # Правая панель (целевая карта)
-            with dpg.child_window(width=450, height=550):
-                dpg.add_text("Целевая карта:")
-                dpg.add_combo(tag="right_maps_combo", items=[], width=430, callback=on_map_select, user_data="right")
-                dpg.add_spacer(height=10)
-                dpg.add_text("Слои выбранной карты:")
-                dpg.add_listbox(tag="right_layers_listbox", items=[], num_items=15, width=430,
-                                callback=on_layer_select, user_data="right")
-                dpg.add_text(tag="right_count_label", default_value="Количество: 0")
+    # Окно метрик запросов (меню "Окна" -> "Метрики запросов")
+    with dpg.window(label="Метрики запросов", tag="metrics_window", show=False, width=1100, height=400,
+                    pos=(400, 150)):
+        with dpg.group(horizontal=True):
+            dpg.add_button(label="Обновить", callback=refresh_metrics_window, width=120)
+            dpg.add_button(label="Сбросить", callback=reset_metrics, width=120)
+            dpg.add_button(label="Экспорт в JSON", callback=export_metrics, width=150)
+            dpg.add_checkbox(label="Автообновление", tag="metrics_auto_refresh", default_value=True)
+            dpg.add_text(tag="metrics_started_text", default_value="")
+        dpg.add_text(tag="metrics_status_text", default_value="")
+        with dpg.table(tag="metrics_table", header_row=True, resizable=True, row_background=True,
+                       borders_innerV=True, borders_outerH=True, scrollY=True):
+            for column in METRICS_COLUMNS:
+                dpg.add_table_column(label=column)
+
+    # Отчет копирования отмеченных слоев (открывается после копирования)
+    with dpg.window(label="Отчет о копировании", tag="copy_report_window", show=False, width=700, height=400,
+                    pos=(600, 200)):
+        dpg.add_text(tag="copy_report_summary", default_value="")
+        with dpg.table(tag="copy_report_table", header_row=True, resizable=True, row_background=True,
+                       borders_innerV=True, borders_outerH=True, scrollY=True):
+            for column in ("Слой", "Id", "Результат", "Новый Id"):
+                dpg.add_table_column(label=column)
+
+    # Копирование слоев левой карты в несколько карт (меню "Окна" или кнопка основного окна)
+    with dpg.window(label="Копирование в несколько карт", tag="fanout_window", show=False, width=700, height=650,
+                    pos=(600, 100)):
+        dpg.add_text(tag="fanout_source_text", default_value="")
+        dpg.add_input_text(tag="fanout_maps_filter", hint="Фильтр карт", width=400, callback=filter_fanout_maps)
+        with dpg.group(horizontal=True):
+            dpg.add_button(label="Отметить найденные", width=160, callback=check_found_fanout_maps, user_data=True)
+            dpg.add_button(label="Снять отметки", width=120, callback=check_found_fanout_maps, user_data=False)
+            dpg.add_text(tag="fanout_checked_label", default_value="Отмечено карт: 0")
+        dpg.add_child_window(tag="fanout_maps_list", height=250)
+        with dpg.group(horizontal=True):
+            dpg.add_button(label="Копировать все слои в отмеченные карты", width=320, callback=fanout_copy_to_maps)
+            dpg.add_input_int(tag="fanout_workers", label="соединений", default_value=1, min_value=1,
+                              min_clamped=True, max_value=32, max_clamped=True, width=100)
+        dpg.add_text(tag="fanout_status_text", default_value="")
+        with dpg.table(tag="fanout_report_table", header_row=True, resizable=True, row_background=True,
+                       borders_innerV=True, borders_outerH=True, scrollY=True, height=200):
+            for column in ("Карта", "Скопировано", "Пропущено"):
+                dpg.add_table_column(label=column)
 
     dpg.bind_font(default_font)
-    dpg.show_font_manager()
+    STARTUP_PROFILE.append(("окно подключения", time.perf_counter() - started))
 
+    # Основное окно строится после подключения (create_main_window в on_connected)
+    started = time.perf_counter()
     dpg.setup_dearpygui()
     dpg.show_viewport()
     show_window(None, None, "connection_window")
-    dpg.start_dearpygui()
-    dpg.destroy_context()
+    STARTUP_PROFILE.append(("setup_dearpygui + show_viewport", time.perf_counter() - started))
+
+    # Собственный цикл отрисовки: каждый кадр применяем результаты фоновых задач
+    first_frame = True
+    try:
+        while dpg.is_dearpygui_running():
+            drain_ui_queue()
+            try:
+                apply_db_changes()
+            except Exception:
+                logger.exception("Ошибка применения изменений из БД")
+            auto_refresh_metrics()
+            started = time.perf_counter()
+            dpg.render_dearpygui_frame()
+            if first_frame:
+                first_frame = False
+                STARTUP_PROFILE.append(("первый кадр", time.perf_counter() - started))
+                import_db_core()
+                if profile_startup:
+                    print_startup_profile()
+    finally:
+        cancel_active_job()
+        dpg.destroy_context()
 
 if __name__ == "__main__":
-    logging.basicConfig(**LOG_CONFIG)
+    arg_parser = argparse.ArgumentParser(description="Управление слоями карт")
+    arg_parser.add_argument("--profile-startup", action="store_true",
+                            help="вывести время импорта и инициализации по этапам")
+    args = arg_parser.parse_args()
+
+    log_listener = setup_logging()
     logger = logging.getLogger(__name__)
     print("Запуск приложения")
     print("=" * 50)
     print("Начало работы приложения")
-    print("Логи будут сохраняться в db_operations.log и выводиться в терминал")
+    print(f"Логи будут сохраняться в {LOG_CONFIG['file']} и выводиться в терминал")
     print("=" * 50)
 
-    create_gui()
-
-    logger.info("Завершение работы приложения")
+    try:
+        create_gui(profile_startup=args.profile_startup)
+    finally:
+        stop_change_listener()
+        if job_executor:
+            job_executor.shutdown(wait=True, cancel_futures=True)
+        if db_pool:
+            db_pool.closeall()
+
+        logger.info("Завершение работы приложения")
+        log_listener.stop()
     print("=" * 50)
     print("Работа приложения завершена")
     print("=" * 50)
\ No newline at end of file
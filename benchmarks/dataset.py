@@ -0,0 +1,150 @@
+import csv
+import os
+import random
+
+# Синтетический набор "Maps"/"Layers" по образцу basemaps.csv: повторяющиеся URL подложек,
+# кириллические имена и дубликаты (MapId, Name, Type), как в реальной базе.
+
+BASEMAPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'basemaps.csv')
+
+# Схема таблиц в объеме, который использует nsttools (типы столбцов - как в basemaps.csv)
+SCHEMA_SQL = """
+    DROP TABLE IF EXISTS public."Layers";
+    DROP TABLE IF EXISTS public."Maps";
+    CREATE TABLE public."Maps" (
+        "Id" serial PRIMARY KEY,
+        "Name" text NOT NULL
+    );
+    CREATE TABLE public."Layers" (
+        "Id" serial PRIMARY KEY,
+        "MapId" integer NOT NULL REFERENCES public."Maps" ("Id"),
+        "Name" text,
+        "Url" text,
+        "Type" text,
+        "IsActive" boolean,
+        "IsExpanded" boolean,
+        "DefaultOpacity" real,
+        "LayerOrder" integer,
+        "IsBaseMap" boolean,
+        "IsDeleted" boolean,
+        "IsSnappable" boolean,
+        "IsUnsearchable" boolean,
+        "GroupLayer" text,
+        "IsReestr" boolean,
+        "IsService" boolean,
+        "IsUserLayer" boolean DEFAULT false
+    );
+    CREATE INDEX ix_layers_map_id ON public."Layers" ("MapId");
+"""
+
+LAYER_COLUMNS = ('"Id"', '"MapId"', '"Name"', '"Url"', '"Type"', '"IsActive"', '"IsExpanded"', '"DefaultOpacity"',
+                 '"LayerOrder"', '"IsBaseMap"', '"IsDeleted"', '"IsSnappable"', '"IsUnsearchable"', '"GroupLayer"',
+                 '"IsReestr"', '"IsService"')
+
+CYRILLIC_NAMES = ['Гугл', 'ЕЭКО', 'Спутник', 'Рельеф', 'Кадастровая карта', 'Схема дорог', 'Ортофотоплан',
+                  'Топографическая карта', 'Лесной фонд', 'Гидрография', 'Публичная карта', 'Яндекс Спутник']
+
+WMS_URLS = ['https://wms.example.org/geoserver/wms', 'https://gis.example.ru/arcgis/services/MapServer/WMSServer']
+
+# Доля строк - копий уже созданного слоя той же карты (дубликаты MapId, Name, Type)
+DUPLICATE_RATE = 0.02
+# Доля не-xyz слоев (в списки и копирование не попадают, но участвуют в запросах)
+WMS_RATE = 0.1
+
+def load_basemaps(path=BASEMAPS_CSV):
+    """(Name, Url) подложек xyz из basemaps.csv."""
+    with open(path, encoding='utf-8') as f:
+        return sorted({(row['Name'], row['Url']) for row in csv.DictReader(f) if row['Type'] == 'xyz'})
+
+def map_sizes(rows, rng):
+    """Размеры карт: одна большая карта (10% строк) для массового копирования и много небольших."""
+    large = max(1, rows // 10)
+    sizes = [large]
+    left = rows - large
+    while left > 0:
+        size = min(left, rng.randint(20, 200))
+        sizes.append(size)
+        left -= size
+    return sizes
+
+def generate_dataset(rows, seed=1):
+    """Строит набор из rows слоев.
+
+    Возвращает (maps, layers): maps - [(Id, Name)], layers - генератор кортежей в порядке LAYER_COLUMNS
+    (строки не держатся в памяти целиком). Id карт и слоев идут с 1, большая карта имеет Id 1.
+    """
+    rng = random.Random(seed)
+    sizes = map_sizes(rows, rng)
+    maps = [(map_id, f"Карта {map_id:06d}" if map_id % 3 else f"Map {map_id:06d}")
+            for map_id in range(1, len(sizes) + 1)]
+    return maps, _generate_layers(sizes, rng)
+
+def _generate_layers(sizes, rng):
+    basemaps = load_basemaps()
+    names = [name for name, _ in basemaps] + CYRILLIC_NAMES
+    urls = [url for _, url in basemaps]
+
+    layer_id = 0
+    for map_id, size in enumerate(sizes, start=1):
+        map_layers = []
+        for number in range(size):
+            if map_layers and rng.random() < DUPLICATE_RATE:
+                source = rng.choice(map_layers)
+                name, url, layer_type = source[2], source[3], source[4]
+            else:
+                # Имена повторяются между картами, внутри карты различаются номером
+                name = f"{rng.choice(names)} {number}"
+                if rng.random() < WMS_RATE:
+                    url, layer_type = rng.choice(WMS_URLS), 'wms'
+                else:
+                    url, layer_type = rng.choice(urls), 'xyz'
+            layer_id += 1
+            layer = (layer_id, map_id, name, url, layer_type, True, False, 0.0, number,
+                     True, False, False, True, f"BACKGROUND:{name}", False, False)
+            map_layers.append(layer)
+            yield layer
+
+def _copy_field(value):
+    # Текстовый формат COPY: \N - NULL, спецсимволы экранируются
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+class CopyReader:
+    """Файлоподобный объект для copy_expert: строки COPY формируются по мере чтения."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += '\t'.join(_copy_field(value) for value in row) + '\n'
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+def load_dataset(conn, maps, layers):
+    """Пересоздает схему и загружает набор через COPY; счетчики Id продолжаются после загруженных."""
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+        cur.copy_expert('COPY public."Maps" ("Id", "Name") FROM STDIN', CopyReader(maps))
+        cur.copy_expert(f'COPY public."Layers" ({", ".join(LAYER_COLUMNS)}) FROM STDIN', CopyReader(layers))
+        cur.execute("""SELECT setval(pg_get_serial_sequence('public."Maps"', 'Id'), (SELECT MAX("Id") FROM public."Maps"));""")
+        cur.execute("""SELECT setval(pg_get_serial_sequence('public."Layers"', 'Id'), (SELECT MAX("Id") FROM public."Layers"));""")
+        cur.execute('ANALYZE public."Maps"; ANALYZE public."Layers";')
+    conn.commit()
+
+def create_map(conn, name):
+    """Создает пустую карту-приемник и возвращает ее Id."""
+    with conn.cursor() as cur:
+        cur.execute('INSERT INTO public."Maps" ("Name") VALUES (%s) RETURNING "Id";', (name,))
+        map_id = cur.fetchone()[0]
+    conn.commit()
+    return map_id
@@ -0,0 +1,386 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import dearpygui.dearpygui as dpg
+import psycopg2
+from psycopg2 import sql
+
+import add_all
+from nstlog import SQL_LOGGER, PARAMS_LOGGER, setup_logging
+from nsttools import (
+    DB_CONFIG, SQL_QUERIES, LOAD_CONFIG, DbPool, LayerStore, ColumnarLayerStore, stream_layers, check_layer_exists,
+    check_layers_exist, ensure_unique_layer_index, copy_layer, bulk_copy_layers, batch_copy_layers,
+    fanout_copy_layers, parallel_fanout_copy, query_metrics
+)
+from benchmarks.dataset import generate_dataset, load_dataset, create_map
+
+# Бенчмарки nsttools на синтетическом наборе слоев во временной базе PostgreSQL.
+# Запуск из корня репозитория:
+#   python -m benchmarks.run --sizes 1k 100k 1M --output benchmarks/results.json
+#   python -m benchmarks.run --initdb            - поднять временный кластер (initdb/pg_ctl из PATH)
+# Результаты (JSON) сравниваются между версиями для отслеживания регрессий.
+
+# ==================== КОНФИГУРАЦИЯ ====================
+BENCH_CONFIG = {
+    'sizes': ['1k', '100k', '1M'],
+    'repeat': 5,        # повторы тяжелых операций (загрузка, массовое копирование)
+    'samples': 50,      # количество замеров легких операций (переключение карты, одиночное копирование)
+    'seed': 1,
+    'fanout_targets': 50,  # число целевых карт при копировании в несколько карт
+    'workers': 4           # соединений при параллельном копировании в несколько карт
+}
+
+logger = logging.getLogger(__name__)
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
+def parse_size(value):
+    """'1k' -> 1000, '1M' -> 1000000, '500' -> 500."""
+    multipliers = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+def summarize(seconds):
+    """Сводка замеров в миллисекундах."""
+    values = sorted(seconds)
+    return {
+        'runs': len(values),
+        'min_ms': round(values[0] * 1000, 3),
+        'median_ms': round(statistics.median(values) * 1000, 3),
+        'p95_ms': round(values[max(0, int(len(values) * 0.95 + 0.5) - 1)] * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+        'mean_ms': round(statistics.fmean(values) * 1000, 3)
+    }
+
+def measure(func, runs):
+    """Выполняет func() runs раз; возвращает (сводка, результат последнего вызова)."""
+    seconds = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - started)
+    return summarize(seconds), result
+
+@contextmanager
+def temporary_cluster():
+    """Временный кластер PostgreSQL (initdb + pg_ctl) в каталоге tmp; подключение через unix-сокет."""
+    initdb = shutil.which('initdb')
+    pg_ctl = shutil.which('pg_ctl')
+    if not initdb or not pg_ctl:
+        raise RuntimeError("initdb/pg_ctl не найдены в PATH")
+    with tempfile.TemporaryDirectory(prefix='nsttools_bench_') as root:
+        data_dir = os.path.join(root, 'data')
+        subprocess.run([initdb, '-D', data_dir, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([pg_ctl, '-D', data_dir, '-l', os.path.join(root, 'server.log'), '-w', 'start',
+                        '-o', f"-c listen_addresses='' -k {root} -c fsync=off"],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            yield {'host': root, 'port': '5432', 'dbname': 'postgres', 'user': 'postgres', 'password': ''}
+        finally:
+            subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+
+@contextmanager
+def throwaway_database(server_params, keep=False):
+    """Создает отдельную базу для бенчмарка на сервере server_params и удаляет ее по завершении."""
+    name = f"nsttools_bench_{os.getpid()}"
+    admin = psycopg2.connect(**server_params)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(sql.SQL("CREATE DATABASE {} ENCODING 'UTF8' TEMPLATE template0").format(
+                sql.Identifier(name)))
+        logger.warning(f"Создана временная база {name}")
+        yield {**server_params, 'dbname': name}
+    finally:
+        if not keep:
+            with admin.cursor() as cur:
+                cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+        admin.close()
+
+# ==================== СЦЕНАРИИ ====================
+def bench_load(pool, repeat):
+    """Подключение и загрузка: список карт (режим lazy) и вся таблица слоев в оба вида кэша (preload)."""
+    def load_maps():
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_QUERIES['get_maps'])
+                return cur.fetchall()
+
+    def preload(store_class):
+        def run():
+            maps = load_maps()
+            store = store_class()
+            store.set_maps(maps)
+            store.load_all([])
+            with pool.connection() as conn:
+                stream_layers(conn, SQL_QUERIES['get_layers'], None, store.extend_loaded)
+            return store
+        return run
+
+    maps_stats, maps = measure(load_maps, repeat)
+    results = {'maps': len(maps), 'lazy_get_maps': maps_stats}
+    for label, store_class in (('preload_indexed', LayerStore), ('preload_columnar', ColumnarLayerStore)):
+        results[label], store = measure(preload(store_class), repeat)
+        results[label]['layers'] = len(store)
+    return results
+
+def bench_map_switch(pool, maps, samples, rng):
+    """Переключение карты в панели кодом GUI: update_layers_list и PanelView (подписи и строки таблицы)
+    в контексте Dear PyGui без окна. cold - слои карты загружаются из БД (режим lazy), warm - карта уже в кэше."""
+    store = LayerStore()
+    store.set_maps(maps)
+    picked = [rng.choice(maps)[0] for _ in range(samples)]
+    # Ядро nsttools в add_all подключается при входе в БД (import_db_core); панели нужны только кэш и режим
+    add_all.logger = logger
+    add_all.LOAD_CONFIG = LOAD_CONFIG
+    add_all.layer_store = store
+
+    def switch(map_id):
+        if not store.is_loaded(map_id):
+            # То же, что load_map_layers: слои читаются из БД и кладутся в кэш перед обновлением панели
+            layers = []
+            with pool.connection() as conn:
+                stream_layers(conn, SQL_QUERIES['get_map_layers'], (map_id,), layers.extend)
+            store.set_map_layers(map_id, layers)
+        add_all.update_layers_list("left", map_id)
+
+    dpg.create_context()
+    try:
+        add_all.create_main_window()
+        cold = []
+        for map_id in dict.fromkeys(picked):
+            started = time.perf_counter()
+            switch(map_id)
+            cold.append(time.perf_counter() - started)
+        warm = []
+        for map_id in picked:
+            started = time.perf_counter()
+            switch(map_id)
+            warm.append(time.perf_counter() - started)
+    finally:
+        dpg.destroy_context()
+        add_all.panels.clear()
+    return {'cold': summarize(cold), 'warm': summarize(warm)}
+
+def source_layers(pool, map_id):
+    layers = []
+    with pool.connection() as conn:
+        stream_layers(conn, SQL_QUERIES['get_map_layers'], (map_id,), layers.extend)
+    return layers
+
+def bench_single_copy(pool, layers, samples, rng):
+    """Одиночное копирование (copy_layer): новый слой и слой, который уже есть в карте-приемнике."""
+    # Дубликаты набора (те же Name и Type) исключаются: вторая копия попала бы в замер вставки как пропуск
+    unique_layers = list({(layer[2], layer[4]): layer for layer in layers}.values())
+    picked = rng.sample(unique_layers, min(samples, len(unique_layers)))
+    with pool.connection() as conn:
+        dst_map_id = create_map(conn, "bench single copy")
+        inserted = []
+        for layer in picked:
+            started = time.perf_counter()
+            copy_layer(conn, dst_map_id, layer)
+            inserted.append(time.perf_counter() - started)
+        skipped = []
+        for layer in picked:
+            started = time.perf_counter()
+            copy_layer(conn, dst_map_id, layer)
+            skipped.append(time.perf_counter() - started)
+    return {'insert': summarize(inserted), 'duplicate_skip': summarize(skipped)}
+
+def bench_bulk_copy(pool, src_map_id, layers, repeat):
+    """Копирование всех слоев большой карты в пустую карту: server (INSERT ... SELECT) и batch."""
+    results = {'source_layers': len(layers)}
+    with pool.connection() as conn:
+        # Пустые карты-приемники создаются заранее, чтобы не входить в замер
+        fresh_maps = iter([create_map(conn, f"bench bulk {number}") for number in range(2 * repeat)])
+
+        def server():
+            return bulk_copy_layers(conn, src_map_id, next(fresh_maps), layers)
+
+        def batch():
+            return batch_copy_layers(conn, next(fresh_maps), layers)
+
+        for label, func in (('server', server), ('batch', batch)):
+            results[label], (new_layers, skipped) = measure(func, repeat)
+            results[label].update({'copied': len(new_layers), 'skipped': skipped})
+    return results
+
+def bench_fanout_copy(pool, src_map_id, layers, targets, repeat):
+    """Копирование набора слоев небольшой карты в targets пустых карт: один запрос на все карты
+    (fanout_copy_layers), партиции на workers соединениях (parallel_fanout_copy) и bulk_copy_layers
+    по очереди для каждой карты."""
+    results = {'source_layers': len(layers), 'targets': targets, 'workers': BENCH_CONFIG['workers']}
+    with pool.connection() as conn:
+        # Пустые карты-приемники создаются заранее, чтобы не входить в замер
+        fresh_maps = iter([create_map(conn, f"bench fanout {number}") for number in range(3 * targets * repeat)])
+
+        def fanout():
+            dst_map_ids = [next(fresh_maps) for _ in range(targets)]
+            new_layers, _ = fanout_copy_layers(conn, src_map_id, dst_map_ids, layers)
+            return len(new_layers)
+
+        def parallel():
+            dst_map_ids = [next(fresh_maps) for _ in range(targets)]
+            new_layers, _, _ = parallel_fanout_copy(pool.conn_params, src_map_id, dst_map_ids, layers,
+                                                    BENCH_CONFIG['workers'])
+            return len(new_layers)
+
+        def per_map():
+            dst_map_ids = [next(fresh_maps) for _ in range(targets)]
+            return sum(len(bulk_copy_layers(conn, src_map_id, map_id, layers)[0]) for map_id in dst_map_ids)
+
+        for label, func in (('fanout', fanout), ('parallel', parallel), ('per_map', per_map)):
+            results[label], copied = measure(func, repeat)
+            results[label]['copied'] = copied
+    return results
+
+def bench_duplicate_checks(pool, src_map_id, layers, samples, rng, repeat):
+    """Проверки дубликатов: по одному слою, пакетом по всей карте и поиск дубликатов по таблице."""
+    picked = rng.sample(layers, min(samples, len(layers)))
+    keys = [(src_map_id, layer[2], layer[4]) for layer in layers]
+    with pool.connection() as conn:
+        single = []
+        for layer in picked:
+            started = time.perf_counter()
+            check_layer_exists(conn, src_map_id, layer[2], layer[4])
+            single.append(time.perf_counter() - started)
+        batch, found = measure(lambda: check_layers_exist(conn, keys), repeat)
+        # В наборе есть дубликаты, поэтому уникальный индекс не создается и замер повторяем
+        scan, duplicates = measure(lambda: ensure_unique_layer_index(conn), repeat)
+    batch.update({'keys': len(keys), 'found': len(found)})
+    scan['duplicates'] = len(duplicates)
+    return {'single': summarize(single), 'batch': batch, 'find_duplicates': scan}
+
+def run_size(conn_params, size, seed):
+    rng = random.Random(seed)
+    rows = parse_size(size)
+    maps, layers = generate_dataset(rows, seed)
+
+    setup_conn = psycopg2.connect(**conn_params)
+    try:
+        started = time.perf_counter()
+        load_dataset(setup_conn, maps, layers)
+        setup_seconds = time.perf_counter() - started
+    finally:
+        setup_conn.close()
+    logger.warning(f"{size}: набор из {rows} слоев загружен за {setup_seconds:.1f} с")
+
+    query_metrics.reset()
+    pool = DbPool(conn_params, minconn=1, maxconn=2)
+    try:
+        started = time.perf_counter()
+        with pool.connection():
+            pass
+        results = {'rows': rows, 'setup_s': round(setup_seconds, 3),
+                   'connect_ms': round((time.perf_counter() - started) * 1000, 3)}
+        repeat, samples = BENCH_CONFIG['repeat'], BENCH_CONFIG['samples']
+        # Большая карта (Id 1) - источник для копирования и проверок дубликатов
+        large_layers = source_layers(pool, 1)
+
+        results['load'] = bench_load(pool, repeat)
+        results['map_switch'] = bench_map_switch(pool, maps, samples, rng)
+        results['single_copy'] = bench_single_copy(pool, large_layers, samples, rng)
+        results['bulk_copy'] = bench_bulk_copy(pool, 1, large_layers, repeat)
+        # Карта Id 2 - набор подложек обычного размера для копирования во много карт
+        results['fanout_copy'] = bench_fanout_copy(pool, 2, source_layers(pool, 2), BENCH_CONFIG['fanout_targets'],
+                                                   repeat)
+        results['duplicate_checks'] = bench_duplicate_checks(pool, 1, large_layers, samples, rng, repeat)
+        results['query_metrics'] = query_metrics.snapshot()
+    finally:
+        pool.closeall()
+    return results
+
+def server_version(conn_params):
+    conn = psycopg2.connect(**conn_params)
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SHOW server_version;')
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(server_params, sizes, keep=False):
+    with throwaway_database(server_params, keep) as conn_params:
+        report = {
+            'meta': {
+                'started': datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'psycopg2': psycopg2.__version__,
+                'server_version': server_version(conn_params),
+                'repeat': BENCH_CONFIG['repeat'],
+                'samples': BENCH_CONFIG['samples'],
+                'seed': BENCH_CONFIG['seed']
+            },
+            'results': {}
+        }
+        for size in sizes:
+            report['results'][size] = run_size(conn_params, size, BENCH_CONFIG['seed'])
+    return report
+
+# ==================== ТОЧКА ВХОДА ====================
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run",
+                                     description="Бенчмарки nsttools на синтетическом наборе слоев.")
+    parser.add_argument("--sizes", nargs="+", default=BENCH_CONFIG['sizes'], help="размеры набора: 1k 100k 1M")
+    parser.add_argument("--repeat", type=int, default=BENCH_CONFIG['repeat'])
+    parser.add_argument("--samples", type=int, default=BENCH_CONFIG['samples'])
+    parser.add_argument("--seed", type=int, default=BENCH_CONFIG['seed'])
+    parser.add_argument("--workers", type=int, default=BENCH_CONFIG['workers'],
+                        help="соединений при параллельном копировании в несколько карт")
+    parser.add_argument("--output", default="-", help="файл результатов JSON ('-' - stdout)")
+    parser.add_argument("--initdb", action="store_true", help="поднять временный кластер PostgreSQL")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    parser.add_argument("--host", default=DB_CONFIG['host'])
+    parser.add_argument("--port", default=DB_CONFIG['port'])
+    parser.add_argument("--dbname", default="postgres", help="база для CREATE/DROP DATABASE")
+    parser.add_argument("--user", default=DB_CONFIG['user'])
+    parser.add_argument("--password", default=DB_CONFIG['password'])
+    args = parser.parse_args(argv)
+
+    BENCH_CONFIG.update({'repeat': args.repeat, 'samples': args.samples, 'seed': args.seed,
+                         'workers': args.workers})
+    listener = setup_logging(level=logging.WARNING, log_file='', console=True,
+                             levels={SQL_LOGGER: logging.WARNING, PARAMS_LOGGER: logging.WARNING})
+    try:
+        if args.initdb:
+            with temporary_cluster() as server_params:
+                report = run_benchmarks(server_params, args.sizes, args.keep)
+        else:
+            server_params = {'host': args.host, 'port': args.port, 'dbname': args.dbname,
+                             'user': args.user, 'password': args.password}
+            report = run_benchmarks(server_params, args.sizes, args.keep)
+    finally:
+        listener.stop()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
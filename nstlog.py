@@ -0,0 +1,134 @@
+import logging
+import logging.handlers
+import itertools
+import queue
+
+# Журналирование без блокировки: обработчики вызывают logger.info(...) и сразу возвращаются,
+# запись в файл и терминал выполняет отдельный поток QueueListener.
+# Модуль не зависит от psycopg2 и GUI, поэтому подключается до отложенного импорта ядра (nsttools).
+
+# ==================== КОНФИГУРАЦИЯ ====================
+# Категории журнала (имена логгеров):
+#   SQL_LOGGER    - текст выполняемых запросов
+#   PARAMS_LOGGER - параметры запросов
+#   UI_LOGGER     - события интерфейса (выбор карты, слоя, обновление списков)
+SQL_LOGGER = 'nsttools.sql'
+PARAMS_LOGGER = 'nsttools.sql.params'
+UI_LOGGER = 'nsttools.ui'
+
+# level        - общий уровень журнала
+# levels       - уровни по категориям; WARNING отключает категорию
+# file         - файл журнала (None - не писать в файл); ротация по max_bytes, хранится backup_count копий
+# console      - дублировать журнал в терминал
+# sample       - выборочное журналирование массовых операций: повторяющийся запрос пишется раз в
+#                sample_every вызовов, а у списков в параметрах выводятся первые sample_items элементов
+LOG_CONFIG = {
+    'level': logging.INFO,
+    'format': '%(asctime)s - %(levelname)s - %(message)s',
+    'levels': {
+        SQL_LOGGER: logging.INFO,
+        PARAMS_LOGGER: logging.INFO,
+        UI_LOGGER: logging.INFO
+    },
+    'file': 'db_operations.log',
+    'max_bytes': 10 * 1024 * 1024,
+    'backup_count': 5,
+    'console': True,
+    'sample': True,
+    'sample_every': 20,
+    'sample_items': 10
+}
+
+sql_logger = logging.getLogger(SQL_LOGGER)
+params_logger = logging.getLogger(PARAMS_LOGGER)
+
+# Счетчики вызовов выборочно журналируемых запросов (ключ - текст запроса)
+_sample_counters = {}
+
+# ==================== НАСТРОЙКА ====================
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке.
+
+    Стандартный prepare() собирает сообщение до постановки в очередь; здесь запись уходит как есть,
+    и msg % args вычисляется в потоке QueueListener. Аргументы записей должны быть неизменяемыми
+    (строки, числа, кортежи) или больше не изменяться после вызова логгера.
+    """
+    def prepare(self, record):
+        return record
+
+def setup_logging(level=None, log_file=None, console=None, levels=None):
+    """Подключает корневой логгер к очереди и запускает QueueListener с обработчиками файла и терминала.
+
+    Параметры, равные None, берутся из LOG_CONFIG; log_file='' - без файла.
+    Возвращает запущенный QueueListener; вызывающий останавливает его (listener.stop())
+    при завершении, чтобы дописать очередь.
+    """
+    level = LOG_CONFIG['level'] if level is None else level
+    log_file = LOG_CONFIG['file'] if log_file is None else log_file
+    console = LOG_CONFIG['console'] if console is None else console
+
+    formatter = logging.Formatter(LOG_CONFIG['format'])
+    handlers = []
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_CONFIG['max_bytes'], backupCount=LOG_CONFIG['backup_count'],
+            encoding='utf-8'))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    for name, category_level in {**LOG_CONFIG['levels'], **(levels or {})}.items():
+        logging.getLogger(name).setLevel(category_level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# ==================== ЖУРНАЛ ЗАПРОСОВ ====================
+class SampledParams:
+    """Параметры запроса для выборочного журнала: длинные списки сокращаются при форматировании."""
+    __slots__ = ('params',)
+
+    def __init__(self, params):
+        self.params = params
+
+    def __str__(self):
+        limit = LOG_CONFIG['sample_items']
+
+        def short(value):
+            if isinstance(value, (list, tuple)) and len(value) > limit:
+                return f"{list(value[:limit])} ... (всего {len(value)})"
+            return repr(value)
+
+        if isinstance(self.params, dict):
+            return "{" + ", ".join(f"{key!r}: {short(value)}" for key, value in self.params.items()) + "}"
+        return short(self.params)
+
+def log_query(query, params=None, sample=False):
+    """Журналирует запрос в категории SQL_LOGGER и параметры в категории PARAMS_LOGGER.
+
+    Сообщение форматируется только в потоке журнала и только если категория включена.
+    sample=True - массовая операция: при LOG_CONFIG['sample'] пишется каждый sample_every-й вызов
+    запроса, а списки в params сокращаются.
+    """
+    if not sql_logger.isEnabledFor(logging.INFO):
+        return
+    if sample and LOG_CONFIG['sample']:
+        every = LOG_CONFIG['sample_every']
+        calls = next(_sample_counters.setdefault(query, itertools.count(1)))
+        if every > 1 and calls % every != 1:
+            return
+        sql_logger.info("Выполнен запрос (вызов %d, журналируется каждый %d-й): %s", calls, every, query)
+        if params and params_logger.isEnabledFor(logging.INFO):
+            params_logger.info("Параметры: %s", SampledParams(params))
+        return
+    sql_logger.info("Выполнен запрос: %s", query)
+    if params and params_logger.isEnabledFor(logging.INFO):
+        params_logger.info("Параметры: %s", params)
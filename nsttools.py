@@ -0,0 +1,1745 @@
+from psycopg2 import OperationalError, InterfaceError, IntegrityError, Error
+from psycopg2.extensions import cursor as BaseCursor
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import argparse
+import logging
+from datetime import datetime
+from contextlib import contextmanager
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+import json
+import math
+import re
+import sys
+import threading
+import time
+
+from nstlog import SQL_LOGGER, PARAMS_LOGGER, log_query, setup_logging
+
+# Ядро работы со слоями без GUI: конфигурация, SQL, пул соединений, кэш слоев и движок копирования.
+# Используется add_all.py и консольным режимом: python -m nsttools copy --src-map ... --dst-map ... --all
+
+# ==================== КОНФИГУРАЦИЯ ====================
+DB_CONFIG = {
+    'host': 'localhost',
+    'port': '5432',
+    'dbname': 'gisp',
+    'user': 'gisp',
+    'password': 'gisp123'
+}
+
+SQL_QUERIES = {
+    'get_maps': 'SELECT t."Id" as id, t."Name" as name FROM public."Maps" as t ORDER BY t."Name";',
+    'get_map_layers': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE t."MapId" = %s AND t."Type" = \'xyz\' ORDER BY t."Name";',
+    'estimate_layers': 'SELECT GREATEST(c.reltuples, 0)::bigint FROM pg_class as c WHERE c.oid = \'public."Layers"\'::regclass;',
+    # Водяной знак синхронизации: максимальные Id и нижняя граница снимка транзакций (32-битный xid)
+    'get_sync_watermark': '''
+        SELECT (SELECT COALESCE(MAX(t."Id"), 0) FROM public."Maps" as t),
+               (SELECT COALESCE(MAX(t."Id"), 0) FROM public."Layers" as t),
+               (txid_snapshot_xmin(txid_current_snapshot()) % 4294967296)::text;
+    ''',
+    # Изменения с момента синхронизации: по Id - только новые строки (индекс по первичному ключу),
+    # по xmin - новые и измененные строки (полный просмотр таблицы; удаления не видны)
+    'get_maps_delta_id': 'SELECT t."Id" as id, t."Name" as name FROM public."Maps" as t WHERE t."Id" > %s;',
+    'get_maps_delta_xmin': 'SELECT t."Id" as id, t."Name" as name FROM public."Maps" as t WHERE age(t.xmin) <= age(%s::xid);',
+    'get_layers_delta_id': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE t."Id" > %s ORDER BY t."Id";',
+    'get_layers_delta_xmin': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE age(t.xmin) <= age(%s::xid) ORDER BY t."Id";',
+    'get_layers': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE t."Type" = \'xyz\' ORDER BY t."Name";',
+    'insert_layer': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        ) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
+        RETURNING "Id"
+    """,
+    # Пакетная вставка через execute_values: %s заменяется страницей строк VALUES (...), (...)
+    'insert_layers_batch': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        VALUES %s
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    # Варианты вставки при наличии уникального индекса ux_layers_map_name_type: дубликаты пропускает сама БД,
+    # пропущенные строки просто не возвращаются в RETURNING
+    'insert_layer_on_conflict': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT ("MapId", "Name", "Type") DO NOTHING
+        RETURNING "Id"
+    """,
+    'insert_layers_batch_on_conflict': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        VALUES %s
+        ON CONFLICT ("MapId", "Name", "Type") DO NOTHING
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    'check_layer_exists': """
+        SELECT 1 
+        FROM public."Layers" as t
+        WHERE t."MapId" = %s AND t."Name" = %s AND t."Type" = %s
+        LIMIT 1
+    """,
+    # Проверка пачки троек (MapId, Name, Type) за один запрос: возвращает уже существующие
+    'check_layers_exist': """
+        SELECT DISTINCT k.map_id, k.name, k.type
+        FROM unnest(%s::int[], %s::text[], %s::text[]) as k(map_id, name, type)
+        JOIN public."Layers" as t
+            ON t."MapId" = k.map_id AND t."Name" = k.name AND t."Type" = k.type
+    """,
+    # Строки по Id из уведомлений NOTIFY
+    'get_layers_by_ids': 'SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type FROM public."Layers" as t WHERE t."Id" = ANY(%s);',
+    'get_maps_by_ids': 'SELECT t."Id" as id, t."Name" as name FROM public."Maps" as t WHERE t."Id" = ANY(%s);',
+    # Миграция: уникальный индекс (MapId, Name, Type) создается, только если в данных нет дубликатов
+    'get_unique_layer_index': 'SELECT i.indisvalid FROM pg_index as i WHERE i.indexrelid = to_regclass(\'public.ux_layers_map_name_type\');',
+    'find_duplicate_layers': """
+        SELECT t."MapId", t."Name", t."Type", count(*) as cnt, array_agg(t."Id" ORDER BY t."Id") as ids
+        FROM public."Layers" as t
+        GROUP BY t."MapId", t."Name", t."Type"
+        HAVING count(*) > 1
+        ORDER BY cnt DESC, t."MapId", t."Name"
+    """,
+    # CONCURRENTLY - без блокировки записи других операторов на время построения (только вне транзакции);
+    # при неудаче остается невалидный индекс (indisvalid = false), он удаляется перед повтором
+    'create_unique_layer_index': 'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ux_layers_map_name_type ON public."Layers" ("MapId", "Name", "Type");',
+    'drop_unique_layer_index': 'DROP INDEX CONCURRENTLY IF EXISTS public.ux_layers_map_name_type;',
+    # Триггеры NOTIFY для живого обновления кэша у всех запущенных экземпляров (устанавливаются по запросу).
+    # В уведомлении только ключи строки: полезная нагрузка pg_notify ограничена 8000 байт, а длинный Url
+    # или имя не должны ломать запись в таблицы; сами строки слушатель читает запросами get_*_by_ids
+    'install_notify_triggers': """
+        CREATE OR REPLACE FUNCTION public.nsttools_notify_change() RETURNS trigger AS $$
+        DECLARE
+            rec record;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+            IF TG_TABLE_NAME = 'Layers' THEN
+                PERFORM pg_notify('nsttools_changes', json_build_object(
+                    'table', 'Layers', 'op', TG_OP, 'id', rec."Id", 'map_id', rec."MapId"
+                )::text);
+            ELSE
+                PERFORM pg_notify('nsttools_changes', json_build_object(
+                    'table', 'Maps', 'op', TG_OP, 'id', rec."Id"
+                )::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS nsttools_notify ON public."Layers";
+        CREATE TRIGGER nsttools_notify AFTER INSERT OR UPDATE OR DELETE ON public."Layers"
+            FOR EACH ROW EXECUTE PROCEDURE public.nsttools_notify_change();
+
+        DROP TRIGGER IF EXISTS nsttools_notify ON public."Maps";
+        CREATE TRIGGER nsttools_notify AFTER INSERT OR UPDATE OR DELETE ON public."Maps"
+            FOR EACH ROW EXECUTE PROCEDURE public.nsttools_notify_change();
+    """,
+    # Массовое копирование одним запросом: дубликаты внутри исходной карты схлопываются DISTINCT ON,
+    # уже существующие в целевой карте слои отсекаются NOT EXISTS. GroupLayer для кириллических
+    # имен передается пакетом через unnest(имена, транслитерации).
+    'bulk_copy_layers': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        SELECT %(dst_map_id)s, s."Name", s."Url", s."Type", NULL, FALSE, 1.0, 2,
+               TRUE, FALSE, FALSE, FALSE, 'BACKGROUND:' || COALESCE(g.group_name, s."Name"), FALSE,
+               FALSE
+        FROM (
+            SELECT DISTINCT ON (t."Name", t."Type") t."Id", t."Name", t."Url", t."Type"
+            FROM public."Layers" as t
+            WHERE t."MapId" = %(src_map_id)s AND t."Type" = 'xyz'
+            ORDER BY t."Name", t."Type", t."Id"
+        ) as s
+        LEFT JOIN unnest(%(names)s::text[], %(group_names)s::text[]) as g(name, group_name)
+            ON g.name = s."Name"
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM public."Layers" as d
+            WHERE d."MapId" = %(dst_map_id)s AND d."Name" = s."Name" AND d."Type" = s."Type"
+        )
+        ORDER BY s."Name"
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    # То же при наличии уникального индекса: вместо NOT EXISTS - ON CONFLICT DO NOTHING (без гонок между операторами)
+    'bulk_copy_layers_on_conflict': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        SELECT %(dst_map_id)s, s."Name", s."Url", s."Type", NULL, FALSE, 1.0, 2,
+               TRUE, FALSE, FALSE, FALSE, 'BACKGROUND:' || COALESCE(g.group_name, s."Name"), FALSE,
+               FALSE
+        FROM (
+            SELECT DISTINCT ON (t."Name", t."Type") t."Id", t."Name", t."Url", t."Type"
+            FROM public."Layers" as t
+            WHERE t."MapId" = %(src_map_id)s AND t."Type" = 'xyz'
+            ORDER BY t."Name", t."Type", t."Id"
+        ) as s
+        LEFT JOIN unnest(%(names)s::text[], %(group_names)s::text[]) as g(name, group_name)
+            ON g.name = s."Name"
+        ORDER BY s."Name"
+        ON CONFLICT ("MapId", "Name", "Type") DO NOTHING
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    # Рассылка набора слоев в несколько карт одним запросом: недостающие тройки (MapId, Name, Type)
+    # для всех целевых карт - декартово произведение слоев источника и unnest(целевые карты) за вычетом
+    # уже существующих
+    'fanout_copy_layers': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        SELECT m.map_id, s."Name", s."Url", s."Type", NULL, FALSE, 1.0, 2,
+               TRUE, FALSE, FALSE, FALSE, 'BACKGROUND:' || COALESCE(g.group_name, s."Name"), FALSE,
+               FALSE
+        FROM (
+            SELECT DISTINCT ON (t."Name", t."Type") t."Id", t."Name", t."Url", t."Type"
+            FROM public."Layers" as t
+            WHERE t."MapId" = %(src_map_id)s AND t."Type" = 'xyz'
+            ORDER BY t."Name", t."Type", t."Id"
+        ) as s
+        CROSS JOIN unnest(%(dst_map_ids)s::int[]) as m(map_id)
+        LEFT JOIN unnest(%(names)s::text[], %(group_names)s::text[]) as g(name, group_name)
+            ON g.name = s."Name"
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM public."Layers" as d
+            WHERE d."MapId" = m.map_id AND d."Name" = s."Name" AND d."Type" = s."Type"
+        )
+        ORDER BY m.map_id, s."Name"
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    'fanout_copy_layers_on_conflict': """
+        INSERT INTO public."Layers" (
+            "MapId", "Name", "Url", "Type", "IsActive", "IsExpanded", "DefaultOpacity", "LayerOrder",
+            "IsBaseMap", "IsDeleted", "IsSnappable", "IsUnsearchable", "GroupLayer", "IsReestr",
+            "IsService"
+        )
+        SELECT m.map_id, s."Name", s."Url", s."Type", NULL, FALSE, 1.0, 2,
+               TRUE, FALSE, FALSE, FALSE, 'BACKGROUND:' || COALESCE(g.group_name, s."Name"), FALSE,
+               FALSE
+        FROM (
+            SELECT DISTINCT ON (t."Name", t."Type") t."Id", t."Name", t."Url", t."Type"
+            FROM public."Layers" as t
+            WHERE t."MapId" = %(src_map_id)s AND t."Type" = 'xyz'
+            ORDER BY t."Name", t."Type", t."Id"
+        ) as s
+        CROSS JOIN unnest(%(dst_map_ids)s::int[]) as m(map_id)
+        LEFT JOIN unnest(%(names)s::text[], %(group_names)s::text[]) as g(name, group_name)
+            ON g.name = s."Name"
+        ORDER BY m.map_id, s."Name"
+        ON CONFLICT ("MapId", "Name", "Type") DO NOTHING
+        RETURNING "Id", "MapId", "Name", "Url", "Type"
+    """,
+    # Постраничный просмотр (режим 'paged'): наличие pg_trgm и индексы для поиска и ключевой пагинации
+    'get_pg_trgm': "SELECT EXISTS (SELECT 1 FROM pg_extension as e WHERE e.extname = 'pg_trgm');",
+    'create_pg_trgm': 'CREATE EXTENSION IF NOT EXISTS pg_trgm;',
+    # Индексы строятся CONCURRENTLY (как ux_layers_map_name_type): невалидный индекс от прерванной
+    # попытки удаляется перед повтором, иначе IF NOT EXISTS оставил бы его как есть
+    'get_index_valid': 'SELECT i.indisvalid FROM pg_index as i WHERE i.indexrelid = to_regclass(%s);',
+    'create_layers_map_name_index': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_layers_map_name_id ON public."Layers" ("MapId", "Name", "Id");',
+    'drop_layers_map_name_index': 'DROP INDEX CONCURRENTLY IF EXISTS public.ix_layers_map_name_id;',
+    'create_layers_name_trgm_index': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_layers_name_trgm ON public."Layers" USING gin ("Name" gin_trgm_ops);',
+    'drop_layers_name_trgm_index': 'DROP INDEX CONCURRENTLY IF EXISTS public.ix_layers_name_trgm;'
+}
+
+# Индексы постраничного просмотра: (имя индекса, ключ SQL создания, ключ SQL удаления)
+BROWSE_INDEXES = (
+    ('public.ix_layers_map_name_id', 'create_layers_map_name_index', 'drop_layers_map_name_index'),
+    ('public.ix_layers_name_trgm', 'create_layers_name_trgm_index', 'drop_layers_name_trgm_index')
+)
+
+# Постраничный просмотр: страница слоев карты по ключу ("Name", "Id") без OFFSET.
+# %(pattern)s - шаблон ILIKE или NULL (без поиска); при установленном pg_trgm к нему добавляется
+# нечеткое совпадение "Name" %% строка поиска (порог pg_trgm.similarity_threshold).
+# Граница (%(name)s, %(id)s) - ключ последней (next) или первой (prev) строки текущей страницы, NULL - с начала.
+# Страница prev выбирается в обратном порядке и разворачивается в клиенте.
+BROWSE_LAYERS_TEMPLATE = """
+    SELECT t."Id" as id, t."MapId" as map_id, t."Name" as name, t."Url" as url, t."Type" as type
+    FROM public."Layers" as t
+    WHERE t."MapId" = %(map_id)s AND t."Type" = 'xyz'
+        AND (%(pattern)s::text IS NULL OR {search})
+        AND (%(name)s::text IS NULL OR (t."Name", t."Id") {op} (%(name)s, %(id)s))
+    ORDER BY t."Name" {order}, t."Id" {order}
+    LIMIT %(limit)s
+"""
+BROWSE_COUNT_TEMPLATE = """
+    SELECT count(*)
+    FROM public."Layers" as t
+    WHERE t."MapId" = %(map_id)s AND t."Type" = 'xyz' AND (%(pattern)s::text IS NULL OR {search})
+"""
+BROWSE_SEARCH = {
+    '': 't."Name" ILIKE %(pattern)s',
+    '_trgm': '(t."Name" ILIKE %(pattern)s OR t."Name" %% %(search)s)'
+}
+for _suffix, _search in BROWSE_SEARCH.items():
+    SQL_QUERIES[f'browse_layers_next{_suffix}'] = BROWSE_LAYERS_TEMPLATE.format(search=_search, op='>', order='ASC')
+    SQL_QUERIES[f'browse_layers_prev{_suffix}'] = BROWSE_LAYERS_TEMPLATE.format(search=_search, op='<', order='DESC')
+    SQL_QUERIES[f'count_browse_layers{_suffix}'] = BROWSE_COUNT_TEMPLATE.format(search=_search)
+
+# Режим массового копирования:
+#   'server' - один INSERT ... SELECT на стороне БД (bulk_copy_layers)
+#   'batch'  - строки формируются в клиенте и отправляются страницами по page_size (insert_layers_batch)
+COPY_CONFIG = {
+    'mode': 'server',
+    'page_size': 500
+}
+
+# Параллельное копирование в много карт (parallel_fanout_copy): целевые карты делятся по MapId на партиции,
+# каждая партиция копируется в своей транзакции на одном из workers соединений.
+#   partition_size - максимум карт в партиции (партиций не меньше, чем workers)
+#   retries        - сколько раз повторять партиции, завершившиеся ошибкой БД; retry_delay - пауза (с)
+PARALLEL_CONFIG = {
+    'workers': 4,
+    'partition_size': 100,
+    'retries': 2,
+    'retry_delay': 1.0
+}
+
+# Пул соединений: health_check_interval - через сколько секунд простоя соединение проверяется SELECT 1
+POOL_CONFIG = {
+    'minconn': 1,
+    'maxconn': 5,
+    'health_check_interval': 30,
+    'checkout_retries': 3
+}
+
+# Загрузка слоев:
+#   'lazy'    - при подключении загружаются только карты, слои карты - при первом выборе в панели
+#   'preload' - при подключении загружается вся таблица слоев (get_layers)
+#   'paged'   - слои в кэш не загружаются: панель листает карту страницами по page_size с сервера,
+#               поиск выполняется в БД (для очень больших карт; память ограничена размером страницы)
+# map_cache_size - сколько карт со слоями держать в памяти в режиме 'lazy'
+# store - представление кэша: 'indexed' (кортежи, LayerStore) или 'columnar' (массивы и словари строк,
+#         ColumnarLayerStore; в разы меньше памяти на больших таблицах)
+# itersize - сколько строк за раз получать из серверного (именованного) курсора при загрузке слоев
+LOAD_CONFIG = {
+    'mode': 'lazy',
+    'map_cache_size': 50,
+    'store': 'indexed',
+    'itersize': 5000,
+    'page_size': 100
+}
+
+# Метрики запросов: время, строки и байты по ключам SQL_QUERIES (курсор MeteredCursor)
+#   enabled      - собирать метрики для соединений пула
+#   result_bytes - оценивать объем полученных данных (сумма длин строковых полей; заметно
+#                  замедляет загрузку больших таблиц, поэтому по умолчанию выключено)
+METRICS_CONFIG = {
+    'enabled': True,
+    'result_bytes': False
+}
+
+logger = logging.getLogger(__name__)
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
+# Таблица транслитерации, совпадающая с translit(name, 'ru', reversed=True) пакета transliterate:
+# один проход str.translate вместо трех проходов и цикла replace() внутри transliterate
+RU_TRANSLIT_TABLE = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'j', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': "'", 'ы': 'y', 'ь': "'", 'э': 'e', 'ю': 'ju', 'я': 'ja',
+    'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'E', 'Ж': 'Zh', 'З': 'Z',
+    'И': 'I', 'Й': 'J', 'К': 'K', 'Л': 'L', 'М': 'M', 'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R',
+    'С': 'S', 'Т': 'T', 'У': 'U', 'Ф': 'F', 'Х': 'H', 'Ц': 'Ts', 'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch',
+    'Ъ': "'", 'Ы': 'Y', 'Ь': "'", 'Э': 'E', 'Ю': 'Ju', 'Я': 'Ja'
+})
+CYRILLIC_RE = re.compile('[\u0400-\u04FF]')
+
+def has_cyrillic(text):
+    return CYRILLIC_RE.search(text) is not None
+
+@lru_cache(maxsize=4096)
+def make_group_layer_name(layer_name):
+    # Если Name содержит кириллицу, транслитерируем в латиницу (результат кэшируется по имени)
+    if has_cyrillic(layer_name):
+        group_layer_name = layer_name.translate(RU_TRANSLIT_TABLE)
+        logger.info(f"Имя слоя '{layer_name}' транслитерировано в '{group_layer_name}'")
+        return group_layer_name
+    return layer_name
+
+def make_group_layer_names(names):
+    """Пакетная транслитерация: {имя: имя для GroupLayer} для всех различных имен из names."""
+    return {name: make_group_layer_name(name) for name in set(names)}
+
+def make_group_layer(layer_name):
+    return f"BACKGROUND:{make_group_layer_name(layer_name)}"
+
+def make_insert_params(map_id, layer, group_layer):
+    # Параметры для INSERT (порядок столбцов как в SQL_QUERIES['insert_layer'])
+    return (
+        map_id,                   # MapId
+        layer[2],                 # Name
+        layer[3],                 # Url
+        layer[4],                 # Type
+        None,                     # IsActive
+        False,                    # IsExpanded
+        1.0,                      # DefaultOpacity
+        2,                        # LayerOrder
+        True,                     # IsBaseMap
+        False,                    # IsDeleted
+        False,                    # IsSnappable
+        False,                    # IsUnsearchable
+        group_layer,              # GroupLayer (с транслитерацией, если нужно)
+        False,                    # IsReestr
+        False                     # IsService
+    )
+
+# ==================== МЕТРИКИ ЗАПРОСОВ ====================
+class LatencyHistogram:
+    """Гистограмма времени выполнения с логарифмическими корзинами.
+
+    Границы корзин растут в 2^(1/4) раза от 10 мкс до ~3 минут, поэтому перцентиль
+    оценивается с погрешностью не больше 19% при постоянном объеме памяти.
+    """
+    BASE = 1e-5
+    STEPS_PER_OCTAVE = 4
+    BUCKETS = 100
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.BASE:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, math.ceil(math.log2(seconds / self.BASE) * self.STEPS_PER_OCTAVE))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """Верхняя граница корзины, в которую попадает q-я доля замеров (q от 0 до 1), в секундах."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.BASE * 2 ** (index / self.STEPS_PER_OCTAVE), self.max)
+        return self.max
+
+class QueryMetrics:
+    """Потокобезопасный сбор метрик по ключам запросов: гистограмма времени, строки, байты, ошибки."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started = datetime.now()
+
+    def record(self, key, seconds, rows=0, bytes_sent=0, bytes_received=0, error=False):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'histogram': LatencyHistogram(), 'rows': 0,
+                                            'bytes_sent': 0, 'bytes_received': 0, 'errors': 0}
+            stats['histogram'].add(seconds)
+            stats['rows'] += rows
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            if error:
+                stats['errors'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.started = datetime.now()
+
+    def snapshot(self):
+        """Сводка по ключам, отсортированная по суммарному времени (времена в миллисекундах)."""
+        with self._lock:
+            items = [(key, stats, stats['histogram']) for key, stats in self._stats.items()]
+            result = {}
+            for key, stats, histogram in sorted(items, key=lambda item: -item[2].total):
+                result[key] = {
+                    'count': histogram.count,
+                    'errors': stats['errors'],
+                    'total_ms': round(histogram.total * 1000, 3),
+                    'p50_ms': round(histogram.percentile(0.50) * 1000, 3),
+                    'p95_ms': round(histogram.percentile(0.95) * 1000, 3),
+                    'p99_ms': round(histogram.percentile(0.99) * 1000, 3),
+                    'max_ms': round(histogram.max * 1000, 3),
+                    'rows': stats['rows'],
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received']
+                }
+            return result
+
+    def export_json(self, path):
+        """Сохраняет снимок метрик в JSON для сравнения между версиями. Возвращает path."""
+        data = {
+            'started': self.started.isoformat(timespec='seconds'),
+            'taken': datetime.now().isoformat(timespec='seconds'),
+            'queries': self.snapshot()
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return path
+
+query_metrics = QueryMetrics()
+
+def metrics_key(query):
+    """Ключ SQL_QUERIES для текста запроса; для прочих запросов - сам текст (сокращенный)."""
+    key = _query_keys.get(query)
+    if key is None and _refresh_query_keys():
+        key = _query_keys.get(query)
+    if key is None:
+        text = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+        key = " ".join(text.split())[:60]
+    return key
+
+_query_keys = {}
+
+def _refresh_query_keys():
+    # SQL_QUERIES может дополняться после импорта, поэтому обратный словарь строится по требованию
+    if len(_query_keys) == len(SQL_QUERIES):
+        return False
+    _query_keys.clear()
+    _query_keys.update({sql: key for key, sql in SQL_QUERIES.items()})
+    return True
+
+class MeteredCursor(BaseCursor):
+    """Курсор, записывающий в query_metrics время, строки и байты каждого запроса.
+
+    Замер начинается в execute() и завершается при следующем execute() или close(), поэтому
+    время чтения именованного (серверного) курсора через fetchmany() тоже учитывается.
+    Запросы, собранные из шаблона (execute_values), размечаются явно: cur.query_key = 'ключ'.
+    """
+    query_key = None
+
+    def execute(self, query, vars=None):
+        self._finish_sample()
+        key = self.query_key or metrics_key(query)
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            query_metrics.record(key, time.perf_counter() - started, error=True)
+            raise
+        self._sample = [key, time.perf_counter() - started, 0, len(self.query or b''), 0]
+        return result
+
+    def _fetched(self, started, rows):
+        sample = getattr(self, '_sample', None)
+        if sample is not None:
+            sample[1] += time.perf_counter() - started
+            sample[2] += len(rows)
+            if METRICS_CONFIG['result_bytes']:
+                sample[4] += sum(len(value) for row in rows for value in row
+                                 if isinstance(value, (str, bytes)))
+        return rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, [row] if row is not None else [])
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        return self._fetched(started, rows)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        return self._fetched(started, super().fetchall())
+
+    def close(self):
+        self._finish_sample()
+        super().close()
+
+    def _finish_sample(self):
+        sample = getattr(self, '_sample', None)
+        if sample is None:
+            return
+        self._sample = None
+        key, seconds, fetched, bytes_sent, bytes_received = sample
+        # У обычного курсора rowcount - все строки результата (или измененные строки INSERT),
+        # у именованного известны только прочитанные через fetch*
+        rows = fetched if self.name else max(self.rowcount, fetched)
+        query_metrics.record(key, seconds, rows, bytes_sent, bytes_received)
+
+# ==================== ПУЛ СОЕДИНЕНИЙ ====================
+class DbPool:
+    """Общий пул соединений PostgreSQL на базе ThreadedConnectionPool.
+
+    При выдаче соединения проверяет его живучесть и при необходимости пересоздает соединение
+    или весь пул (например, после перезапуска сервера или обрыва по таймауту простоя).
+    """
+
+    def __init__(self, conn_params, minconn=None, maxconn=None):
+        self.conn_params = conn_params
+        self.minconn = minconn or POOL_CONFIG['minconn']
+        self.maxconn = maxconn or POOL_CONFIG['maxconn']
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._owners = {}             # id(соединения) -> выдавший его пул (пул мог быть пересоздан)
+        self._pool = self._create_pool()
+
+    def _create_pool(self):
+        logger.info(f"Создание пула соединений (min={self.minconn}, max={self.maxconn})")
+        factory = {'cursor_factory': MeteredCursor} if METRICS_CONFIG['enabled'] else {}
+        pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self.conn_params, **factory)
+        # При создании открывается minconn соединений, но возвращенные соединения держатся в пуле до maxconn:
+        # иначе putconn закрывает все сверх minconn и каждая параллельная задача открывает новое соединение
+        pool.minconn = self.maxconn
+        return pool
+
+    def _reset_pool(self):
+        with self._lock:
+            logger.warning("Пересоздание пула соединений")
+            # Закрываются только свободные соединения старого пула: выданные другим потокам дорабатывают
+            # и закрываются в _release (closeall() оборвал бы, например, идущее массовое копирование)
+            old_pool = self._pool
+            for conn in old_pool._pool:
+                self._last_used.pop(id(conn), None)
+                conn.close()
+            old_pool._pool.clear()
+            self._pool = self._create_pool()
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < POOL_CONFIG['health_check_interval']:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def _getconn(self):
+        pool = self._pool
+        conn = pool.getconn()
+        self._owners[id(conn)] = pool
+        return conn
+
+    def _release(self, conn, close=False):
+        # Соединение возвращается в выдавший его пул; если пул уже пересоздан, соединение закрывается
+        pool = self._owners.pop(id(conn), None)
+        if pool is self._pool:
+            pool.putconn(conn, close=close)
+        elif not conn.closed:
+            conn.close()
+
+    def _checkout(self):
+        for attempt in range(POOL_CONFIG['checkout_retries']):
+            try:
+                conn = self._getconn()
+            except OperationalError as e:
+                logger.error(f"Не удалось получить соединение (попытка {attempt + 1}): {e}")
+                self._reset_pool()
+                continue
+            if self._is_alive(conn):
+                return conn
+            logger.warning("Соединение из пула недоступно, переподключение")
+            self._last_used.pop(id(conn), None)
+            self._release(conn, close=True)
+        # Последняя попытка: ошибки пробрасываются вызывающему
+        self._reset_pool()
+        return self._getconn()
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except (OperationalError, InterfaceError):
+                    pass
+            raise
+        finally:
+            self._last_used[id(conn)] = time.monotonic()
+            self._release(conn, close=bool(conn.closed))
+
+    def closeall(self):
+        self._pool.closeall()
+
+# ==================== ХРАНИЛИЩЕ СЛОЕВ ====================
+class LayerStore:
+    """Индексированный кэш слоев в памяти (строки в формате get_layers: Id, MapId, Name, Url, Type).
+
+    Индексы: MapId -> слои карты, Id -> слой, множество ключей (MapId, Name, Type) для локальной
+    проверки дубликатов и имя карты -> MapId. Все индексы обновляются инкрементально.
+    При max_maps карты вытесняются по принципу LRU (режим 'lazy').
+    """
+
+    def __init__(self, max_maps=None):
+        self.max_maps = max_maps
+        self.all_loaded = False
+        self._map_id_by_name = {}
+        self._layers_by_map = OrderedDict()
+        self._layer_by_id = {}
+        self._keys = set()
+
+    def __len__(self):
+        return len(self._layer_by_id)
+
+    def set_maps(self, maps):
+        self._map_id_by_name = {m[1]: m[0] for m in maps}
+
+    def map_id_by_name(self, name):
+        return self._map_id_by_name.get(name)
+
+    def load_all(self, layers):
+        self._layers_by_map.clear()
+        self._layer_by_id.clear()
+        self._keys.clear()
+        self.all_loaded = True
+        self.add(layers)
+
+    def set_map_layers(self, map_id, layers, pinned=()):
+        self._drop_map(map_id)
+        self._layers_by_map[map_id] = []
+        self.add(layers)
+        self._evict(pinned={map_id, *pinned})
+
+    def is_loaded(self, map_id):
+        return self.all_loaded or map_id in self._layers_by_map
+
+    def layers_for_map(self, map_id):
+        if map_id not in self._layers_by_map:
+            return []
+        self._layers_by_map.move_to_end(map_id)
+        return list(self._layers_by_map[map_id])
+
+    def get(self, layer_id):
+        return self._layer_by_id.get(layer_id)
+
+    def extend_loaded(self, layers):
+        return self.add(layers)
+
+    def contains(self, map_id, name, layer_type):
+        return (map_id, name, layer_type) in self._keys
+
+    def add(self, layers):
+        # Незагруженные карты не трогаем: при выборе они будут загружены из БД вместе с новыми слоями
+        added = 0
+        for layer in layers:
+            map_layers = self._layers_by_map.get(layer[1])
+            if map_layers is None:
+                if not self.all_loaded:
+                    continue
+                map_layers = self._layers_by_map[layer[1]] = []
+            if layer[0] in self._layer_by_id:
+                continue
+            map_layers.append(layer)
+            self._layer_by_id[layer[0]] = layer
+            self._keys.add((layer[1], layer[2], layer[4]))
+            added += 1
+        return added
+
+    def remove(self, layer_id):
+        layer = self._layer_by_id.pop(layer_id, None)
+        if layer is None:
+            return None
+        map_layers = self._layers_by_map[layer[1]]
+        map_layers.remove(layer)
+        # Ключ снимаем, только если в карте не осталось слоя с тем же Name и Type
+        if not any(l[2] == layer[2] and l[4] == layer[4] for l in map_layers):
+            self._keys.discard((layer[1], layer[2], layer[4]))
+        return layer
+
+    def remove_many(self, layer_ids):
+        # Пачка удалений: список каждой затронутой карты и ее ключи пересобираются один раз
+        ids_by_map = {}
+        for layer_id in layer_ids:
+            layer = self._layer_by_id.pop(layer_id, None)
+            if layer is not None:
+                ids_by_map.setdefault(layer[1], set()).add(layer_id)
+        for map_id, ids in ids_by_map.items():
+            map_layers = self._layers_by_map[map_id]
+            removed = [layer for layer in map_layers if layer[0] in ids]
+            map_layers[:] = [layer for layer in map_layers if layer[0] not in ids]
+            left = {(layer[2], layer[4]) for layer in map_layers}
+            for layer in removed:
+                if (layer[2], layer[4]) not in left:
+                    self._keys.discard((layer[1], layer[2], layer[4]))
+        return sum(len(ids) for ids in ids_by_map.values())
+
+    def _drop_map(self, map_id):
+        for layer in self._layers_by_map.pop(map_id, ()):
+            self._layer_by_id.pop(layer[0], None)
+            self._keys.discard((layer[1], layer[2], layer[4]))
+
+    def _evict(self, pinned):
+        if not self.max_maps:
+            return
+        for map_id in list(self._layers_by_map):
+            if len(self._layers_by_map) <= self.max_maps:
+                break
+            if map_id not in pinned:
+                self._drop_map(map_id)
+                logger.info(f"Слои карты {map_id} вытеснены из кэша")
+
+class StringPool:
+    """Словарное кодирование строк: каждое уникальное значение хранится один раз и получает целый код."""
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def encode(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            if isinstance(value, str):
+                value = sys.intern(value)
+            code = len(self.values)
+            self.values.append(value)
+            self._codes[value] = code
+        return code
+
+    def code(self, value):
+        return self._codes.get(value)
+
+class ColumnarLayerStore:
+    """Колоночный вариант LayerStore с тем же API для панелей.
+
+    Id и MapId хранятся в массивах array('q'), Name/Url/Type - кодами в array('i') со словарями
+    StringPool. Кортежи слоев собираются только при выдаче (layers_for_map, get).
+    """
+
+    def __init__(self, max_maps=None):
+        self.max_maps = max_maps
+        self.all_loaded = False
+        self._map_id_by_name = {}
+        self._reset_columns()
+
+    def _reset_columns(self):
+        self._ids = array('q')
+        self._map_ids = array('q')
+        self._name_codes = array('i')
+        self._url_codes = array('i')
+        self._type_codes = array('i')
+        self._names = StringPool()
+        self._urls = StringPool()
+        self._types = StringPool()
+        self._rows_by_map = OrderedDict()
+        self._keys_by_map = {}
+        # Индекс Id -> строка: отсортированные пары, новые Id из последовательности дописываются в конец
+        self._sorted_ids = array('q')
+        self._sorted_rows = array('q')
+        self._sorted_dirty = False
+        # Удаленные строки помечаются MapId = -1 и убираются при следующем уплотнении колонок
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._ids) - self._removed
+
+    def set_maps(self, maps):
+        self._map_id_by_name = {m[1]: m[0] for m in maps}
+
+    def map_id_by_name(self, name):
+        return self._map_id_by_name.get(name)
+
+    def load_all(self, layers):
+        self._reset_columns()
+        self.all_loaded = True
+        self.extend_loaded(layers)
+
+    def set_map_layers(self, map_id, layers, pinned=()):
+        self._drop_maps({map_id})
+        self._rows_by_map[map_id] = array('q')
+        self._keys_by_map[map_id] = set()
+        self.extend_loaded(layers)
+        self._evict(pinned={map_id, *pinned})
+
+    def is_loaded(self, map_id):
+        return self.all_loaded or map_id in self._rows_by_map
+
+    def _row(self, row):
+        return (
+            self._ids[row],
+            self._map_ids[row],
+            self._names.values[self._name_codes[row]],
+            self._urls.values[self._url_codes[row]],
+            self._types.values[self._type_codes[row]]
+        )
+
+    def layers_for_map(self, map_id):
+        rows = self._rows_by_map.get(map_id)
+        if rows is None:
+            return []
+        self._rows_by_map.move_to_end(map_id)
+        return [self._row(row) for row in rows]
+
+    def _find_row(self, layer_id):
+        if self._sorted_dirty:
+            live_rows = (row for row in range(len(self._ids)) if self._map_ids[row] != -1)
+            order = sorted(live_rows, key=self._ids.__getitem__)
+            self._sorted_ids = array('q', (self._ids[row] for row in order))
+            self._sorted_rows = array('q', order)
+            self._sorted_dirty = False
+        i = bisect_left(self._sorted_ids, layer_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == layer_id:
+            return self._sorted_rows[i]
+        return None
+
+    def get(self, layer_id):
+        row = self._find_row(layer_id)
+        return None if row is None else self._row(row)
+
+    def remove(self, layer_id):
+        row = self._find_row(layer_id)
+        if row is None:
+            return None
+        layer = self._row(row)
+        # Строки карты и индекс Id отсортированы: удаляем запись бинарным поиском без перестройки индекса
+        rows = self._rows_by_map[layer[1]]
+        del rows[bisect_left(rows, row)]
+        i = bisect_left(self._sorted_ids, layer_id)
+        del self._sorted_ids[i]
+        del self._sorted_rows[i]
+        key = self._key(self._name_codes[row], self._type_codes[row])
+        if not any(self._key(self._name_codes[r], self._type_codes[r]) == key for r in rows):
+            self._keys_by_map[layer[1]].discard(key)
+        self._map_ids[row] = -1
+        self._removed += 1
+        # Без вытеснения карт (режим preload) уплотнение не происходит - запускаем его, когда удаленных больше половины
+        if self._removed * 2 > len(self._ids):
+            self._compact(set())
+        return layer
+
+    def remove_many(self, layer_ids):
+        # Пачка удалений: строки каждой карты, ее ключи и индекс Id фильтруются одним проходом
+        rows_by_map = {}
+        for layer_id in set(layer_ids):
+            row = self._find_row(layer_id)
+            if row is not None:
+                rows_by_map.setdefault(self._map_ids[row], set()).add(row)
+        if not rows_by_map:
+            return 0
+        for map_id, removed in rows_by_map.items():
+            rows = self._rows_by_map[map_id]
+            self._rows_by_map[map_id] = rows = array('q', (row for row in rows if row not in removed))
+            left = {self._key(self._name_codes[row], self._type_codes[row]) for row in rows}
+            for row in removed:
+                key = self._key(self._name_codes[row], self._type_codes[row])
+                if key not in left:
+                    self._keys_by_map[map_id].discard(key)
+                self._map_ids[row] = -1
+            self._removed += len(removed)
+        live = [i for i, row in enumerate(self._sorted_rows) if self._map_ids[row] != -1]
+        self._sorted_ids = array('q', (self._sorted_ids[i] for i in live))
+        self._sorted_rows = array('q', (self._sorted_rows[i] for i in live))
+        if self._removed * 2 > len(self._ids):
+            self._compact(set())
+        return sum(len(removed) for removed in rows_by_map.values())
+
+    @staticmethod
+    def _key(name_code, type_code):
+        return (name_code << 32) | type_code
+
+    def contains(self, map_id, name, layer_type):
+        name_code = self._names.code(name)
+        type_code = self._types.code(layer_type)
+        if name_code is None or type_code is None:
+            return False
+        return self._key(name_code, type_code) in self._keys_by_map.get(map_id, ())
+
+    def add(self, layers):
+        # Уже известные Id отсеиваем до вставки, чтобы индекс Id перестраивался не более одного раза
+        seen = set()
+        new_layers = []
+        for layer in layers:
+            if layer[0] not in seen and self.get(layer[0]) is None:
+                seen.add(layer[0])
+                new_layers.append(layer)
+        return self.extend_loaded(new_layers)
+
+    def extend_loaded(self, layers):
+        # Строки считаются новыми (получены из БД), проверка Id не выполняется.
+        # Незагруженные карты не трогаем: при выборе они будут загружены из БД вместе с новыми слоями
+        added = 0
+        for layer_id, map_id, name, url, layer_type in layers:
+            rows = self._rows_by_map.get(map_id)
+            if rows is None:
+                if not self.all_loaded:
+                    continue
+                rows = self._rows_by_map[map_id] = array('q')
+                self._keys_by_map[map_id] = set()
+
+            row = len(self._ids)
+            name_code = self._names.encode(name)
+            type_code = self._types.encode(layer_type)
+            self._ids.append(layer_id)
+            self._map_ids.append(map_id)
+            self._name_codes.append(name_code)
+            self._url_codes.append(self._urls.encode(url))
+            self._type_codes.append(type_code)
+            rows.append(row)
+            self._keys_by_map[map_id].add(self._key(name_code, type_code))
+
+            if not self._sorted_ids or layer_id > self._sorted_ids[-1]:
+                self._sorted_ids.append(layer_id)
+                self._sorted_rows.append(row)
+            else:
+                self._sorted_dirty = True
+            added += 1
+        return added
+
+    def _drop_maps(self, map_ids):
+        map_ids = {map_id for map_id in map_ids if map_id in self._rows_by_map}
+        if map_ids:
+            self._compact(map_ids)
+
+    def _compact(self, map_ids):
+        # Уплотняем колонки без строк удаляемых карт и удаленных слоев; словари строк сохраняются
+        dropped = map_ids | {-1}
+        keep = [row for row in range(len(self._ids)) if self._map_ids[row] not in dropped]
+        self._removed = 0
+        columns = (self._ids, self._map_ids, self._name_codes, self._url_codes, self._type_codes)
+        compacted = [array(column.typecode, (column[row] for row in keep)) for column in columns]
+        self._ids, self._map_ids, self._name_codes, self._url_codes, self._type_codes = compacted
+
+        for map_id in map_ids:
+            del self._rows_by_map[map_id]
+            del self._keys_by_map[map_id]
+        for rows in self._rows_by_map.values():
+            del rows[:]
+        for row, map_id in enumerate(self._map_ids):
+            self._rows_by_map[map_id].append(row)
+        self._sorted_dirty = True
+
+    def _evict(self, pinned):
+        if not self.max_maps or len(self._rows_by_map) <= self.max_maps:
+            return
+        evicted = []
+        for map_id in self._rows_by_map:
+            if len(self._rows_by_map) - len(evicted) <= self.max_maps:
+                break
+            if map_id not in pinned:
+                evicted.append(map_id)
+        self._drop_maps(evicted)
+        for map_id in evicted:
+            logger.info(f"Слои карты {map_id} вытеснены из кэша")
+
+def create_layer_store(max_maps=None):
+    store_class = ColumnarLayerStore if LOAD_CONFIG['store'] == 'columnar' else LayerStore
+    return store_class(max_maps=max_maps)
+
+# ==================== ПОИСК ПО ИМЕНАМ ====================
+class NameIndex:
+    """Индекс имен для фильтров списков слоев и карт.
+
+    Каждое имя индексируется в формах casefold() и транслитерации (для кириллицы), поэтому
+    запрос "sputnik" находит "Спутник", а запрос "Спут" - и "Спутник", и "Sputnik".
+    Запросы из 1-2 символов ищутся по началам слов, из 3 символов - по триграмме, длиннее -
+    по подстроке: кандидаты берутся из самого короткого списка триграмм запроса и проверяются вхождением.
+    Списки ключей хранятся в array('q'); после remove() и повторного add() в них остаются
+    устаревшие ключи, такие ключи проверяются по текущему имени.
+    """
+
+    def __init__(self, items=()):
+        self._text = {}          # key -> формы имени через '\n'
+        self._trigrams = {}      # триграмма -> array ключей
+        self._word_starts = {}   # первые 1-2 символа слова -> array ключей
+        self._stale = set()      # ключи, у которых в списках могут быть записи старого имени
+        self.add(items)
+
+    def __len__(self):
+        return len(self._text)
+
+    def __contains__(self, key):
+        return key in self._text
+
+    def __iter__(self):
+        return iter(self._text)
+
+    @staticmethod
+    def forms(text):
+        folded = " ".join(text.split()).casefold()
+        if has_cyrillic(folded):
+            return (folded, folded.translate(RU_TRANSLIT_TABLE))
+        return (folded,)
+
+    def add(self, items):
+        """Добавляет пары (key, имя); key - целое (Id слоя или карты)."""
+        trigram_index = self._trigrams
+        start_index = self._word_starts
+        for key, name in items:
+            if key in self._text:
+                self._stale.add(key)
+            forms = self.forms(name)
+            text = self._text[key] = "\n".join(forms)
+            # Триграммы не пересекают границу форм: в них не попадает '\n'
+            grams = {text[i:i + 3] for i in range(len(text) - 2)}
+            grams = [gram for gram in grams if "\n" not in gram]
+            words = text.split()
+            grams += {word[:1] for word in words} | {word[:2] for word in words if len(word) > 1}
+            for gram in grams:
+                index = trigram_index if len(gram) == 3 else start_index
+                postings = index.get(gram)
+                if postings is None:
+                    postings = index[gram] = array('q')
+                postings.append(key)
+
+    def remove(self, key):
+        if self._text.pop(key, None) is not None:
+            self._stale.add(key)
+
+    def search(self, query):
+        """Множество key, имена которых подходят под query (пустой запрос - None, фильтра нет)."""
+        query_forms = self.forms(query)
+        if not query_forms[0]:
+            return None
+        found = set()
+        for form in query_forms:
+            found |= self._search_form(form, found)
+        return found
+
+    def _search_form(self, form, found_before):
+        # found_before - ключи, уже найденные по другой форме запроса; повторно не проверяются
+        text = self._text
+        if len(form) <= 3:
+            index = self._trigrams if len(form) == 3 else self._word_starts
+            found = set(index.get(form, ()))
+            # Списки точные, кроме устаревших ключей
+            for key in found & self._stale:
+                forms = text.get(key)
+                if forms is None or not any(self._matches(name_form, form) for name_form in forms.split("\n")):
+                    found.discard(key)
+            return found
+
+        postings = []
+        for i in range(len(form) - 2):
+            trigram_postings = self._trigrams.get(form[i:i + 3])
+            if trigram_postings is None:
+                return set()
+            postings.append(trigram_postings)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        candidates -= found_before
+        for other in postings[1:3]:
+            candidates.intersection_update(other)
+        get_text = text.get
+        return {key for key in candidates if form in get_text(key, "")}
+
+    @staticmethod
+    def _matches(name_form, form):
+        if len(form) == 3:
+            return form in name_form
+        return any(word.startswith(form) for word in name_form.split())
+
+# ==================== ДВИЖОК КОПИРОВАНИЯ ====================
+def stream_layers(conn, query, params, on_rows, progress=None, total=0):
+    """Выполняет запрос слоев через именованный (серверный) курсор и передает строки в on_rows порциями.
+
+    В памяти клиента одновременно находится не больше LOAD_CONFIG['itersize'] строк результата.
+    """
+    itersize = LOAD_CONFIG['itersize']
+    loaded = 0
+    with conn.cursor(name="layers_stream") as cur:
+        cur.itersize = itersize
+        log_query(query, params)
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            on_rows(rows)
+            loaded += len(rows)
+            if progress:
+                progress(loaded, max(total, loaded))
+    return loaded
+
+def check_layer_exists(conn, map_id, name, layer_type):
+    try:
+        with conn.cursor() as cur:
+            log_query(SQL_QUERIES['check_layer_exists'], (map_id, name, layer_type))
+            cur.execute(SQL_QUERIES['check_layer_exists'], (map_id, name, layer_type))
+            return cur.fetchone() is not None
+    except Error as e:
+        logger.error(f"Ошибка при проверке слоя: {e}")
+        return False
+
+def check_layers_exist(conn, keys):
+    """Возвращает множество троек (MapId, Name, Type) из keys, которые уже есть в "Layers"."""
+    keys = list(keys)
+    if not keys:
+        return set()
+    params = ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys])
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES['check_layers_exist'], params, sample=True)
+        cur.execute(SQL_QUERIES['check_layers_exist'], params)
+        return set(cur.fetchall())
+
+def load_change_rows(conn, changes):
+    """Дополняет уведомления NOTIFY (table, op, id[, map_id]) текущими строками из БД.
+
+    Для INSERT/UPDATE подставляются name, url, type и map_id слоя или name карты; если строки уже нет
+    (удалена после уведомления), изменение становится DELETE. Возвращает тот же список.
+    """
+    wanted = {'Layers': set(), 'Maps': set()}
+    for change in changes:
+        if change.get('op') != 'DELETE' and change.get('table') in wanted:
+            wanted[change['table']].add(change['id'])
+
+    rows = {}
+    with conn.cursor() as cur:
+        for table, query in (('Layers', 'get_layers_by_ids'), ('Maps', 'get_maps_by_ids')):
+            if not wanted[table]:
+                continue
+            params = (sorted(wanted[table]),)
+            log_query(SQL_QUERIES[query], params, sample=True)
+            cur.execute(SQL_QUERIES[query], params)
+            rows.update(((table, row[0]), row) for row in cur.fetchall())
+
+    for change in changes:
+        if change.get('op') == 'DELETE' or change.get('table') not in wanted:
+            continue
+        row = rows.get((change['table'], change['id']))
+        if row is None:
+            change['op'] = 'DELETE'
+        elif change['table'] == 'Layers':
+            change.update(map_id=row[1], name=row[2], url=row[3], type=row[4])
+        else:
+            change['name'] = row[1]
+    return changes
+
+def has_unique_layer_index(conn):
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES['get_unique_layer_index'])
+        cur.execute(SQL_QUERIES['get_unique_layer_index'])
+        row = cur.fetchone()
+    return bool(row and row[0])
+
+def ensure_unique_layer_index(conn):
+    """Создает уникальный индекс "Layers"("MapId", "Name", "Type"), если данные это позволяют.
+
+    Индекс строится CREATE INDEX CONCURRENTLY в режиме autocommit, запись в "Layers" при этом не блокируется.
+    Невалидный индекс от прерванной попытки удаляется перед построением. Если во время построения другой
+    оператор добавил дубликат, невалидный индекс удаляется и дубликаты ищутся заново (если их уже нет,
+    пробрасывается исходная ошибка).
+    Возвращает список дубликатов (MapId, Name, Type, количество, [Id]); если он не пуст, индекс не создается.
+    """
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES['find_duplicate_layers'])
+        cur.execute(SQL_QUERIES['find_duplicate_layers'])
+        duplicates = cur.fetchall()
+        if duplicates:
+            conn.rollback()
+            return duplicates
+
+        log_query(SQL_QUERIES['get_unique_layer_index'])
+        cur.execute(SQL_QUERIES['get_unique_layer_index'])
+        row = cur.fetchone()
+    conn.rollback()
+    if row and row[0]:
+        return []
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if row:
+                logger.warning("Удаление невалидного уникального индекса слоев от прерванной попытки")
+                log_query(SQL_QUERIES['drop_unique_layer_index'])
+                cur.execute(SQL_QUERIES['drop_unique_layer_index'])
+            log_query(SQL_QUERIES['create_unique_layer_index'])
+            try:
+                cur.execute(SQL_QUERIES['create_unique_layer_index'])
+            except IntegrityError as e:
+                logger.warning(f"Дубликат слоя появился во время построения индекса: {e}")
+                log_query(SQL_QUERIES['drop_unique_layer_index'])
+                cur.execute(SQL_QUERIES['drop_unique_layer_index'])
+                log_query(SQL_QUERIES['find_duplicate_layers'])
+                cur.execute(SQL_QUERIES['find_duplicate_layers'])
+                duplicates = cur.fetchall()
+                if not duplicates:
+                    # Дубликат уже удален - индекс не создан, ошибка передается вызывающему
+                    raise
+                return duplicates
+    finally:
+        conn.autocommit = False
+    return []
+
+def has_pg_trgm(conn):
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES['get_pg_trgm'])
+        cur.execute(SQL_QUERIES['get_pg_trgm'])
+        return cur.fetchone()[0]
+
+def create_browse_indexes(conn):
+    """Устанавливает pg_trgm и создает индексы постраничного просмотра: (MapId, Name, Id) и GIN по "Name".
+
+    Индексы строятся CREATE INDEX CONCURRENTLY в режиме autocommit, запись в "Layers" не блокируется.
+    Невалидный индекс от прерванной попытки удаляется и строится заново.
+    """
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            log_query(SQL_QUERIES['create_pg_trgm'])
+            cur.execute(SQL_QUERIES['create_pg_trgm'])
+            for index_name, create_key, drop_key in BROWSE_INDEXES:
+                log_query(SQL_QUERIES['get_index_valid'], (index_name,))
+                cur.execute(SQL_QUERIES['get_index_valid'], (index_name,))
+                row = cur.fetchone()
+                if row and row[0]:
+                    continue
+                if row:
+                    logger.warning(f"Удаление невалидного индекса {index_name} от прерванной попытки")
+                    log_query(SQL_QUERIES[drop_key])
+                    cur.execute(SQL_QUERIES[drop_key])
+                log_query(SQL_QUERIES[create_key])
+                cur.execute(SQL_QUERIES[create_key])
+    finally:
+        conn.autocommit = False
+
+def ilike_pattern(search):
+    # Подстрока для ILIKE: спецсимволы шаблона экранируются
+    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+def browse_params(map_id, search):
+    search = (search or "").strip() or None
+    return {'map_id': map_id, 'search': search, 'pattern': ilike_pattern(search) if search else None}
+
+def fetch_layer_page(conn, map_id, search=None, after=None, before=None, limit=None, trgm=False):
+    """Страница xyz-слоев карты в порядке ("Name", "Id") в формате get_layers.
+
+    after/before - ключ (Name, Id): строки строго после него или строго перед ним (предыдущая страница).
+    search - подстрока имени (ILIKE; с trgm - еще и нечеткое совпадение pg_trgm).
+    """
+    direction = 'prev' if before is not None else 'next'
+    key = f"browse_layers_{direction}{'_trgm' if trgm else ''}"
+    boundary = before if before is not None else after
+    params = browse_params(map_id, search)
+    params.update({
+        'name': boundary[0] if boundary else None,
+        'id': boundary[1] if boundary else None,
+        'limit': limit or LOAD_CONFIG['page_size']
+    })
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES[key], params)
+        cur.execute(SQL_QUERIES[key], params)
+        rows = cur.fetchall()
+    return rows[::-1] if direction == 'prev' else rows
+
+def count_browse_layers(conn, map_id, search=None, trgm=False):
+    """Количество xyz-слоев карты, подходящих под search (для подписи в режиме 'paged')."""
+    key = f"count_browse_layers{'_trgm' if trgm else ''}"
+    params = browse_params(map_id, search)
+    with conn.cursor() as cur:
+        log_query(SQL_QUERIES[key], params)
+        cur.execute(SQL_QUERIES[key], params)
+        return cur.fetchone()[0]
+
+def copy_layer(conn, dst_map_id, layer, on_conflict=False):
+    """Копирует один слой в dst_map_id. Возвращает новый Id или None, если слой уже есть в целевой карте."""
+    if not on_conflict and check_layer_exists(conn, dst_map_id, layer[2], layer[4]):
+        return None
+
+    query = SQL_QUERIES['insert_layer_on_conflict' if on_conflict else 'insert_layer']
+    with conn.cursor() as cur:
+        params = make_insert_params(dst_map_id, layer, make_group_layer(layer[2]))
+        log_query(query, params)
+        cur.execute(query, params)
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+def bulk_copy_layers(conn, src_map_id, dst_map_id, source_layers, on_conflict=False):
+    """Копирует все xyz-слои карты src_map_id в dst_map_id одним INSERT ... SELECT.
+
+    Возвращает (список новых слоев в формате get_layers, количество пропущенных слоев).
+    """
+    names, group_names = group_name_params(source_layers)
+    params = {
+        'src_map_id': src_map_id,
+        'dst_map_id': dst_map_id,
+        'names': names,
+        'group_names': group_names
+    }
+    query = SQL_QUERIES['bulk_copy_layers_on_conflict' if on_conflict else 'bulk_copy_layers']
+    with conn.cursor() as cur:
+        log_query(query, params, sample=True)
+        cur.execute(query, params)
+        new_layers = cur.fetchall()
+    conn.commit()
+
+    skipped_count = len(source_layers) - len(new_layers)
+    logger.info(f"Массовое копирование {src_map_id} -> {dst_map_id}: "
+                f"скопировано {len(new_layers)}, пропущено {skipped_count}")
+    return new_layers, skipped_count
+
+def group_name_params(source_layers):
+    # Для запросов INSERT ... SELECT передаются только имена, для которых GroupLayer отличается от Name
+    group_names_by_name = make_group_layer_names(layer[2] for layer in source_layers)
+    names = [name for name, group_name in group_names_by_name.items() if group_name != name]
+    return names, [group_names_by_name[name] for name in names]
+
+def fanout_copy_layers(conn, src_map_id, dst_map_ids, source_layers, on_conflict=False):
+    """Копирует все xyz-слои карты src_map_id в каждую из карт dst_map_ids одним INSERT ... SELECT
+    в одной транзакции.
+
+    Возвращает (список новых слоев в формате get_layers, {Id целевой карты: (скопировано, пропущено)}).
+    Исходная карта и повторы в dst_map_ids отбрасываются.
+    """
+    dst_map_ids = [map_id for map_id in dict.fromkeys(dst_map_ids) if map_id != src_map_id]
+    if not dst_map_ids:
+        return [], {}
+    names, group_names = group_name_params(source_layers)
+    params = {
+        'src_map_id': src_map_id,
+        'dst_map_ids': dst_map_ids,
+        'names': names,
+        'group_names': group_names
+    }
+    query = SQL_QUERIES['fanout_copy_layers_on_conflict' if on_conflict else 'fanout_copy_layers']
+    with conn.cursor() as cur:
+        log_query(query, params, sample=True)
+        cur.execute(query, params)
+        new_layers = cur.fetchall()
+    conn.commit()
+
+    copied = dict.fromkeys(dst_map_ids, 0)
+    for layer in new_layers:
+        copied[layer[1]] += 1
+    report = {map_id: (count, len(source_layers) - count) for map_id, count in copied.items()}
+    logger.info(f"Рассылка слоев карты {src_map_id} в {len(dst_map_ids)} карт: "
+                f"скопировано {len(new_layers)}")
+    return new_layers, report
+
+def partition_map_ids(map_ids, workers, partition_size):
+    # Непрерывные диапазоны MapId: не больше partition_size карт и не меньше workers партиций
+    map_ids = sorted(map_ids)
+    size = max(1, min(partition_size, math.ceil(len(map_ids) / workers)))
+    return [map_ids[start:start + size] for start in range(0, len(map_ids), size)]
+
+def parallel_fanout_copy(conn_params, src_map_id, dst_map_ids, source_layers, workers=None, progress=None,
+                         on_conflict=False):
+    """Копирует слои карты src_map_id во множество карт параллельно на нескольких соединениях.
+
+    Целевые карты делятся по MapId на партиции (partition_map_ids); каждая партиция - fanout_copy_layers
+    на своем соединении и в своей транзакции. Для соединений создается отдельный пул на workers
+    соединений. Партиции с ошибкой БД повторяются до PARALLEL_CONFIG['retries'] раз.
+    progress(обработано строк, всего) вызывается в вызывающем потоке после каждой партиции; исключение
+    из progress (отмена) отменяет еще не начатые партиции, уже закоммиченные остаются.
+
+    Возвращает (новые слои, {Id карты: (скопировано, пропущено)}, [Id карт из партиций, не прошедших
+    после всех повторов]).
+    """
+    workers = workers or PARALLEL_CONFIG['workers']
+    dst_map_ids = set(dst_map_ids) - {src_map_id}
+    if not dst_map_ids:
+        return [], {}, []
+    pending = partition_map_ids(dst_map_ids, workers, PARALLEL_CONFIG['partition_size'])
+    total = len(dst_map_ids) * len(source_layers)
+    logger.info(f"Параллельное копирование карты {src_map_id} в {len(dst_map_ids)} карт: "
+                f"партиций {len(pending)}, соединений {workers}")
+
+    new_layers = []
+    report = {}
+    done_rows = 0
+    # minconn = workers: соединения рабочих потоков остаются в пуле и переиспользуются между партициями
+    pool = DbPool(conn_params, minconn=workers, maxconn=workers)
+
+    def copy_partition(map_ids):
+        with pool.connection() as conn:
+            return fanout_copy_layers(conn, src_map_id, map_ids, source_layers, on_conflict)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="nsttools-sync") as executor:
+            for attempt in range(PARALLEL_CONFIG['retries'] + 1):
+                if attempt:
+                    time.sleep(PARALLEL_CONFIG['retry_delay'])
+                    logger.warning(f"Повтор партиций с ошибкой ({len(pending)}), попытка {attempt + 1}")
+                futures = {executor.submit(copy_partition, map_ids): map_ids for map_ids in pending}
+                pending = []
+                try:
+                    for future in as_completed(futures):
+                        map_ids = futures[future]
+                        try:
+                            partition_layers, partition_report = future.result()
+                        except Error as e:
+                            logger.error(f"Ошибка в партиции карт {map_ids[0]}..{map_ids[-1]}: {e}")
+                            pending.append(map_ids)
+                            continue
+                        new_layers.extend(partition_layers)
+                        report.update(partition_report)
+                        done_rows += len(map_ids) * len(source_layers)
+                        if progress:
+                            progress(done_rows, total)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+                if not pending:
+                    break
+    finally:
+        pool.closeall()
+
+    failed = sorted(map_id for map_ids in pending for map_id in map_ids)
+    logger.info(f"Параллельное копирование карты {src_map_id}: скопировано {len(new_layers)} слоев "
+                f"в {len(report)} карт, не выполнено карт: {len(failed)}")
+    return new_layers, report, failed
+
+def insert_layers_batch(conn, rows, page_size=None, progress=None, on_conflict=False):
+    """Вставляет строки (кортежи make_insert_params) страницами через execute_values.
+
+    После каждой страницы вызывает progress(обработано, всего), если он задан.
+    Возвращает новые слои в формате get_layers. При on_conflict строки-дубликаты пропускаются БД
+    и в результат не попадают. Коммит выполняет вызывающий.
+    """
+    if not rows:
+        return []
+    page_size = page_size or COPY_CONFIG['page_size']
+    key = 'insert_layers_batch_on_conflict' if on_conflict else 'insert_layers_batch'
+    query = SQL_QUERIES[key]
+
+    returned = []
+    with conn.cursor() as cur:
+        # execute_values выполняет собранный из шаблона текст, ключ метрик задается явно
+        if isinstance(cur, MeteredCursor):
+            cur.query_key = key
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            log_query(query, page, sample=True)
+            returned.extend(execute_values(cur, query, page, page_size=page_size, fetch=True))
+            if progress:
+                progress(min(start + page_size, len(rows)), len(rows))
+
+    # Порядок строк RETURNING не гарантирован: новые слои берутся из самих возвращенных строк
+    return [tuple(row) for row in returned]
+
+def copy_layers(conn, dst_map_id, source_layers, page_size=None, progress=None, on_conflict=False):
+    """Копирует набор слоев в dst_map_id в одной транзакции: одна проверка существующих слоев
+    (check_layers_exist, при on_conflict - уникальный индекс при вставке) и пакетная вставка.
+
+    Возвращает отчет по каждому слою source_layers в исходном порядке: список (слой, статус, новый слой),
+    статус 'copied' - скопирован, 'exists' - уже есть в целевой карте, 'repeated' - повтор имени и типа
+    внутри набора; новый слой (формат get_layers) задан только для 'copied'.
+    """
+    candidates = {}
+    for layer in source_layers:
+        candidates.setdefault((dst_map_id, layer[2], layer[4]), layer)
+    existing = set() if on_conflict else check_layers_exist(conn, candidates.keys())
+
+    group_names = make_group_layer_names(layer[2] for layer in candidates.values())
+    rows = [make_insert_params(dst_map_id, layer, f"BACKGROUND:{group_names[layer[2]]}")
+            for key, layer in candidates.items() if key not in existing]
+
+    new_layers = insert_layers_batch(conn, rows, page_size, progress, on_conflict)
+    conn.commit()
+
+    inserted = {(layer[2], layer[4]): layer for layer in new_layers}
+    report = []
+    seen = set()
+    for layer in source_layers:
+        key = (layer[2], layer[4])
+        if key in seen:
+            report.append((layer, 'repeated', None))
+            continue
+        seen.add(key)
+        new_layer = inserted.get(key)
+        report.append((layer, 'copied' if new_layer else 'exists', new_layer))
+    return report
+
+def batch_copy_layers(conn, dst_map_id, source_layers, page_size=None, progress=None, on_conflict=False):
+    """Копирует source_layers в dst_map_id пакетной вставкой (режим COPY_CONFIG['mode'] == 'batch').
+
+    Существующие в целевой карте слои определяются одним запросом check_layers_exist,
+    а при on_conflict - уникальным индексом прямо при вставке.
+    Возвращает (новые слои, количество пропущенных).
+    """
+    report = copy_layers(conn, dst_map_id, source_layers, page_size, progress, on_conflict)
+    new_layers = [new_layer for _, status, new_layer in report if status == 'copied']
+
+    skipped_count = len(source_layers) - len(new_layers)
+    logger.info(f"Пакетное копирование в карту {dst_map_id}: "
+                f"скопировано {len(new_layers)}, пропущено {skipped_count}")
+    return new_layers, skipped_count
+
+
+# ==================== КОНСОЛЬНЫЙ РЕЖИМ ====================
+# Коды возврата консольного режима
+EXIT_OK = 0
+EXIT_DB_ERROR = 1
+EXIT_USAGE = 2
+EXIT_NOT_FOUND = 3
+
+def resolve_map(maps, value):
+    # Карта задается Id или точным именем
+    if value.isdigit():
+        return next((m for m in maps if m[0] == int(value)), None)
+    return next((m for m in maps if m[1] == value), None)
+
+def run_copy(args):
+    conn_params = {
+        'host': args.host,
+        'port': args.port,
+        'dbname': args.dbname,
+        'user': args.user,
+        'password': args.password
+    }
+    COPY_CONFIG['mode'] = args.mode
+    if args.page_size is not None:
+        COPY_CONFIG['page_size'] = args.page_size
+
+    try:
+        pool = DbPool(conn_params, minconn=1, maxconn=1)
+    except OperationalError as e:
+        logger.error(f"Ошибка подключения: {e}")
+        return EXIT_DB_ERROR
+
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                log_query(SQL_QUERIES['get_maps'])
+                cur.execute(SQL_QUERIES['get_maps'])
+                maps = cur.fetchall()
+
+            src_map = resolve_map(maps, args.src_map)
+            dst_values = args.dst_map or []
+            dst_maps = [resolve_map(maps, value) for value in dst_values]
+            for value, found in zip([args.src_map] + dst_values, [src_map] + dst_maps):
+                if found is None:
+                    logger.error(f"Карта не найдена: {value}")
+                    return EXIT_NOT_FOUND
+            if args.all_maps:
+                dst_maps = [m for m in maps if m[0] != src_map[0]]
+                if not dst_maps:
+                    logger.error(f"Нет карт для копирования, кроме исходной '{src_map[1]}'")
+                    return EXIT_NOT_FOUND
+
+            source_layers = []
+            stream_layers(conn, SQL_QUERIES['get_map_layers'], (src_map[0],), source_layers.extend)
+            if not args.all:
+                wanted = set(args.layer)
+                source_layers = [layer for layer in source_layers if layer[2] in wanted]
+                missing = wanted - {layer[2] for layer in source_layers}
+                if missing:
+                    logger.error(f"Слои не найдены в карте '{src_map[1]}': {', '.join(sorted(missing))}")
+                    return EXIT_NOT_FOUND
+
+            on_conflict = has_unique_layer_index(conn)
+            started = time.monotonic()
+            failed = []
+            if args.workers > 1:
+                # Партиции целевых карт копируются параллельно на отдельных соединениях
+                _, report, failed = parallel_fanout_copy(conn_params, src_map[0], [m[0] for m in dst_maps],
+                                                         source_layers, args.workers, on_conflict=on_conflict)
+            elif args.all and len(dst_maps) > 1:
+                # Несколько целевых карт: один запрос на все карты
+                _, report = fanout_copy_layers(conn, src_map[0], [m[0] for m in dst_maps], source_layers,
+                                               on_conflict)
+            elif args.all and COPY_CONFIG['mode'] == 'server':
+                new_layers, skipped_count = bulk_copy_layers(conn, src_map[0], dst_maps[0][0], source_layers,
+                                                             on_conflict)
+                report = {dst_maps[0][0]: (len(new_layers), skipped_count)}
+            else:
+                report = {}
+                for dst_map in dst_maps:
+                    new_layers, skipped_count = batch_copy_layers(conn, dst_map[0], source_layers,
+                                                                  on_conflict=on_conflict)
+                    report[dst_map[0]] = (len(new_layers), skipped_count)
+            elapsed = time.monotonic() - started
+    except Error as e:
+        logger.error(f"Ошибка при копировании: {e}")
+        return EXIT_DB_ERROR
+    finally:
+        pool.closeall()
+        if args.metrics:
+            query_metrics.export_json(args.metrics)
+
+    for dst_map in dst_maps:
+        if dst_map[0] in report:
+            copied_count, skipped_count = report[dst_map[0]]
+            print(f"{src_map[1]} -> {dst_map[1]}: скопировано {copied_count}, пропущено {skipped_count}")
+    processed = len(source_layers) * len(report)
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Обработано {processed} слоев в {len(report)} карт за {elapsed:.3f} с ({rate:.0f} слоев/с)")
+    if failed:
+        logger.error(f"Не скопировано в карты после повторов ({len(failed)}): {', '.join(map(str, failed))}")
+        return EXIT_DB_ERROR
+    return EXIT_OK
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nsttools",
+        description="Консольное копирование слоев между картами (без GUI)."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    copy_parser = commands.add_parser("copy", help="скопировать xyz-слои из одной карты в другую")
+    copy_parser.add_argument("--src-map", required=True, help="исходная карта: Id или имя")
+    targets = copy_parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument("--dst-map", action="append",
+                         help="целевая карта: Id или имя (можно повторять - копирование в несколько карт)")
+    targets.add_argument("--all-maps", action="store_true", help="копировать во все карты, кроме исходной")
+    what = copy_parser.add_mutually_exclusive_group(required=True)
+    what.add_argument("--all", action="store_true", help="скопировать все слои карты")
+    what.add_argument("--layer", action="append", help="имя слоя для копирования (можно повторять)")
+    copy_parser.add_argument("--mode", choices=("server", "batch"), default=COPY_CONFIG['mode'],
+                             help="режим массового копирования (см. COPY_CONFIG)")
+    copy_parser.add_argument("--page-size", type=int, help="размер страницы для режима batch")
+    copy_parser.add_argument("--workers", type=int, default=1,
+                             help="число соединений для параллельного копирования в несколько карт "
+                                  "(партиции по MapId, см. PARALLEL_CONFIG)")
+    copy_parser.add_argument("--host", default=DB_CONFIG['host'])
+    copy_parser.add_argument("--port", default=DB_CONFIG['port'])
+    copy_parser.add_argument("--dbname", default=DB_CONFIG['dbname'])
+    copy_parser.add_argument("--user", default=DB_CONFIG['user'])
+    copy_parser.add_argument("--password", default=DB_CONFIG['password'])
+    copy_parser.add_argument("--metrics", metavar="PATH", help="сохранить метрики запросов в JSON")
+    copy_parser.add_argument("-v", "--verbose", action="store_true", help="выводить SQL-запросы и отладочный журнал")
+
+    args = parser.parse_args(argv)
+    # Проверка сочетаний ключей до подключения: ошибка использования - код 2 и при недоступной БД
+    if args.command == "copy":
+        if args.workers < 1:
+            copy_parser.error("--workers должно быть не меньше 1")
+        if args.page_size is not None and args.page_size < 1:
+            copy_parser.error("--page-size должно быть не меньше 1")
+        if (args.all_maps or args.workers > 1) and not args.all:
+            copy_parser.error("--all-maps и --workers используются только вместе с --all")
+
+    # Консольный режим пишет журнал только в терминал; без -v - только предупреждения и ошибки
+    level = logging.INFO if args.verbose else logging.WARNING
+    listener = setup_logging(level=level, log_file='', console=True,
+                             levels={SQL_LOGGER: level, PARAMS_LOGGER: level})
+    try:
+        if args.command == "copy":
+            return run_copy(args)
+        parser.print_usage()
+        return EXIT_USAGE
+    finally:
+        listener.stop()
+
+if __name__ == "__main__":
+    sys.exit(main())